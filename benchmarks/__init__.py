@@ -0,0 +1,3 @@
+'''Benchmarks for the per-frame paths of the game.
+
+Run with ``python -m benchmarks.run --help`` from the repository root.'''
@@ -0,0 +1,88 @@
+'''Writes synthetic TMX maps for the benchmarks.'''
+import os
+import random
+
+from ld35 import resources
+
+TILE = 16
+
+_MAP = '''<?xml version="1.0" encoding="UTF-8"?>
+<map version="1.0" orientation="orthogonal" renderorder="right-down" width="{width}" height="{height}" tilewidth="16" tileheight="16" nextobjectid="{next_id}">
+ <tileset firstgid="1" name="tiles" tilewidth="16" tileheight="16" tilecount="130" columns="10">
+  <image source="{tiles}" width="160" height="208"/>
+ </tileset>
+ <layer name="Tile Layer 1" width="{width}" height="{height}">
+  <data encoding="csv">
+{ground}
+  </data>
+ </layer>
+ <objectgroup name="Objects">
+{objects}
+ </objectgroup>
+</map>
+'''
+
+_OBJECT = '  <object id="{id}" {name}type="{type}" x="{x}" y="{y}" width="{w}" height="{h}">{properties}</object>'
+_PROPERTY = '<property name="{0}" value="{1}"/>'
+
+
+def _object(id, type, x, y, w=32, h=32, name=None, **properties):
+    props = ''
+    if properties:
+        props = '<properties>{0}</properties>'.format(
+            ''.join(_PROPERTY.format(k, v) for k, v in sorted(properties.items())))
+    return _OBJECT.format(id=id, type=type, x=x, y=y, w=w, h=h,
+                          name='name="{0}" '.format(name) if name else '',
+                          properties=props)
+
+
+def write_map(filename, walls=100, triggers=50, sprites=50, seed=0):
+    '''Writes a map with the given number of Wall objects, Switch triggers and
+    RisingPlatform sprites scattered at random around a Player in the middle.
+
+    Every switch targets a platform when there are any.'''
+    rnd = random.Random(seed)
+
+    count = walls + triggers + sprites + 1
+    # roughly a quarter of the 32px slots are used so objects rarely overlap
+    side = max(32, int((count * 4) ** 0.5) * 2)
+    width = height = side
+
+    slots = [(x * 2 * TILE, y * 2 * TILE)
+             for x in range(1, side // 2 - 1)
+             for y in range(1, side // 2 - 1)]
+    rnd.shuffle(slots)
+    player_slot = (side // 2 * TILE, side // 2 * TILE)
+    slots = [s for s in slots if s != player_slot]
+
+    objects = [_object(1, 'Player', player_slot[0], player_slot[1], name='Player')]
+    next_id = 2
+
+    platform_ids = []
+    for i in range(sprites):
+        x, y = slots.pop()
+        objects.append(_object(next_id, 'RisingPlatform', x, y, floor=rnd.randint(0, 1)))
+        platform_ids.append(next_id)
+        next_id += 1
+
+    for i in range(triggers):
+        x, y = slots.pop()
+        target = {'target_id': rnd.choice(platform_ids)} if platform_ids else {}
+        objects.append(_object(next_id, 'Switch', x, y, 16, 16, **target))
+        next_id += 1
+
+    for i in range(walls):
+        x, y = slots.pop()
+        objects.append(_object(next_id, 'Wall', x, y, TILE * rnd.randint(1, 2),
+                               TILE * rnd.randint(1, 2), floor=rnd.randint(0, 1)))
+        next_id += 1
+
+    ground = ',\n'.join(','.join(str(rnd.randint(1, 20)) for x in range(width))
+                        for y in range(height))
+
+    with open(filename, 'w') as f:
+        f.write(_MAP.format(width=width, height=height, next_id=next_id,
+                            tiles=os.path.abspath(resources.get('examples/placeholder_tiles.png')),
+                            ground=ground, objects='\n'.join(objects)))
+
+    return filename
@@ -0,0 +1,209 @@
+'''Times the per-frame paths of the game on a synthetic map.
+
+Each benchmark gets a fresh headless Game, is warmed up, and then timed for a
+number of frames.  Results are printed as JSON and can be saved and compared
+against a saved baseline:
+
+    python -m benchmarks.run --walls 1000 --save baseline.json
+    python -m benchmarks.run --walls 1000 --baseline baseline.json
+'''
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+import pygame
+
+from ld35.game import Game
+from ld35.tilemap import Tilemap
+from ld35 import resources
+
+from benchmarks.mapgen import write_map
+
+D_T = 1000.0 / 60
+# directions held by the scripted player, changed every 20 frames
+INPUTS = ['k_left', 'k_up', 'k_right', 'k_down']
+
+
+def drive_player(game, frame):
+    '''Walks the player around so the benchmarks see movement.'''
+    if frame % 20 == 0:
+        player = game.player
+        player.reset_inputs()
+        key = INPUTS[(frame // 20) % len(INPUTS)]
+        setattr(player, key, -1 if key in ('k_left', 'k_up') else 1)
+
+
+def bench_on_loop(game):
+    return lambda: game.on_loop(D_T)
+
+
+def bench_on_collide(game):
+    def frame():
+        game.on_collide()
+    return frame, lambda: game.on_loop(D_T)
+
+
+def bench_depth_update(game):
+    return lambda: game.group.update(D_T)
+
+
+def bench_trigger_update(game):
+    # every trigger, asleep or not, to time the per-object dispatch
+    triggers = list(game.triggers)
+
+    def frame():
+        for trigger in triggers:
+            trigger.update(D_T)
+    return frame, lambda: (game.on_loop(D_T), game.on_collide())
+
+
+def bench_group_draw(game):
+    surface = game._display_surf
+
+    def frame():
+        game.group.draw(surface)
+    return frame, lambda: (game.on_loop(D_T), game.on_collide())
+
+
+def bench_tilemap_draw(game):
+    surface = game._display_surf
+    tilemap = Tilemap(resources.load_image('examples/platformgrass.png'),
+                      game.map_layer.data.map_size[0] * 16,
+                      game.map_layer.data.map_size[1] * 16)
+
+    def frame():
+        tilemap.draw(surface, game.camera)
+    return frame, lambda: (game.on_loop(D_T), game.on_collide())
+
+
+# name -> setup(game) returning either the timed callable, or the timed
+# callable and an untimed one run before it to advance the simulation
+BENCHMARKS = [
+    ('on_loop', bench_on_loop),
+    ('on_collide', bench_on_collide),
+    ('depth_update', bench_depth_update),
+    ('trigger_update', bench_trigger_update),
+    ('group_draw', bench_group_draw),
+    ('tilemap_draw', bench_tilemap_draw),
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def summarize(times):
+    ms = [t * 1000.0 for t in times]
+    return {
+        'frames': len(ms),
+        'mean_ms': sum(ms) / len(ms),
+        'p50_ms': percentile(ms, 50),
+        'p90_ms': percentile(ms, 90),
+        'p99_ms': percentile(ms, 99),
+        'max_ms': max(ms),
+    }
+
+
+def run_benchmark(filename, setup, frames, warmup):
+    game = Game(filename, headless=True)
+    timed = setup(game)
+    advance = None
+    if isinstance(timed, tuple):
+        timed, advance = timed
+
+    times = []
+    for frame in range(warmup + frames):
+        drive_player(game, frame)
+        if advance is not None:
+            advance()
+        start = default_timer()
+        timed()
+        elapsed = default_timer() - start
+        if frame >= warmup:
+            times.append(elapsed)
+    return summarize(times)
+
+
+def compare(results, baseline, threshold):
+    '''Returns a {name: ratio} of p50 times against the baseline and the names
+    that got slower than threshold.'''
+    ratios = {}
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if not base or not base['p50_ms']:
+            continue
+        ratio = result['p50_ms'] / base['p50_ms']
+        ratios[name] = ratio
+        if ratio > threshold:
+            regressions.append(name)
+    return ratios, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--walls', type=int, default=200)
+    parser.add_argument('--triggers', type=int, default=100)
+    parser.add_argument('--sprites', type=int, default=100)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', default=[],
+                        help='run only the named benchmark (repeatable)')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--threshold', type=float, default=1.10,
+                        help='p50 ratio over the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='ld35-bench-')
+    try:
+        filename = write_map(os.path.join(tmpdir, 'bench.tmx'),
+                             args.walls, args.triggers, args.sprites, args.seed)
+
+        results = {
+            'params': {
+                'walls': args.walls,
+                'triggers': args.triggers,
+                'sprites': args.sprites,
+                'frames': args.frames,
+                'seed': args.seed,
+            },
+            'benchmarks': {},
+        }
+        for name, setup in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            results['benchmarks'][name] = run_benchmark(filename, setup,
+                                                         args.frames, args.warmup)
+    finally:
+        shutil.rmtree(tmpdir)
+        pygame.quit()
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        ratios, regressions = compare(results, baseline, args.threshold)
+        results['baseline_ratio'] = ratios
+        results['regressions'] = regressions
+        if regressions:
+            status = 1
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
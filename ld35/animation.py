@@ -0,0 +1,74 @@
+from bisect import bisect_right
+
+import resources
+
+
+class Animation(object):
+    '''A shared, read-only sequence of frames and how long each is shown (ms).
+
+    Entities do not own one of these, they hold an AnimationCursor into it.'''
+    def __init__(self, frames, durations, loop=True):
+        self.frames = list(frames)
+        self.durations = list(durations)
+        self.loop = loop
+
+        # frame i is shown from starts[i] until starts[i + 1]
+        self.starts = []
+        total = 0
+        for duration in self.durations:
+            self.starts.append(total)
+            total += duration
+        self.length = total
+
+    def frame_at(self, time):
+        '''Returns the frame shown time ms after the animation started.'''
+        if self.length <= 0:
+            return self.frames[0]
+        if self.loop:
+            time %= self.length
+        elif time >= self.length:
+            return self.frames[-1]
+        return self.frames[bisect_right(self.starts, time) - 1]
+
+
+class AnimationCursor(object):
+    '''Playback position in an Animation, advanced by update(d_t).'''
+    __slots__ = ('animation', 'time', 'playing')
+
+    def __init__(self, animation=None):
+        self.animation = animation
+        self.time = 0
+        self.playing = True
+
+    def play(self, animation=None):
+        '''Plays animation from the start, or resumes the current one.'''
+        if animation is not None and animation is not self.animation:
+            self.animation = animation
+            self.time = 0
+        self.playing = True
+
+    def pause(self):
+        self.playing = False
+
+    def update(self, d_t):
+        if self.playing:
+            self.time += d_t
+
+    @property
+    def image(self):
+        return self.animation.frame_at(self.time)
+
+
+def load_animations(filename, rows, cols, sequences):
+    '''Slices a packaged sprite sheet once and returns {name: Animation}.
+
+    sequences is a tuple of (name, ((frame index, duration ms), ...)) pairs.
+    The result is cached and shared, so do not modify it.'''
+    def loader():
+        images = resources.load_sheet(filename, rows=rows, cols=cols)
+        animations = {}
+        for name, frames in sequences:
+            animations[name] = Animation([images[i] for i, _ in frames],
+                                         [duration for _, duration in frames])
+        return animations
+    return resources.cache.get(('animations', filename, rows, cols, sequences), loader)
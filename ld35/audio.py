@@ -0,0 +1,171 @@
+import itertools
+import logging
+
+import pygame
+
+import resources
+
+logger = logging.getLogger()
+
+
+class AudioManager(object):
+    '''Plays sound effects on channels reserved per category and fades music
+    in and out a little each update rather than blocking.
+
+    Each category gets its own channels, so a long sound in one category can
+    not stop another category from playing.  When all of a category's
+    channels are busy a sound only plays if it has a higher priority than one
+    of them, which it then replaces.'''
+
+    # category -> number of channels (voices) reserved for it
+    categories = {
+        'footsteps': 1,
+        'switches': 2,
+        'effects': 3,
+    }
+
+    # loaded once when the mixer is set up
+    preload = (
+        'assets/step_concrete.wav',
+        'assets/step_grass.wav',
+        'assets/step_water.wav',
+    )
+
+    def __init__(self, fade_ms=1000):
+        self.fade_ms = fade_ms
+        self.volume = 1.0  # music volume when not fading
+        self._music_volume = 0.0  # tracked here, the mixer rounds what it is given
+
+        self._sounds = {}
+        self._voices = None  # category -> [[channel, priority, order]]
+        self._no_audio = False  # set when the mixer could not be opened
+        self._order = itertools.count()
+
+        self._music = None       # file playing, or fading in
+        self._next_music = None  # file to start when the current one has faded out
+        self._fading_out = False
+
+    @property
+    def initialized(self):
+        # the mixer may have been shut down since, e.g. by pygame.quit
+        return self._voices is not None and pygame.mixer.get_init() is not None
+
+    def reset(self):
+        '''Forgets the channels and sounds, which pygame.quit leaves unusable,
+        so the next play sets the mixer up again.'''
+        self._voices = None
+        self._sounds = {}
+        self._no_audio = False
+        self._music = None
+        self._next_music = None
+        self._fading_out = False
+        self._music_volume = 0.0
+
+    def init(self):
+        '''Sets up the mixer if needed, reserves channels and preloads sounds.
+        Called by the first play or play_music.  Returns False if there is no
+        mixer to play with.'''
+        if self._no_audio:
+            return False
+        if not pygame.mixer.get_init():
+            try:
+                pygame.mixer.init()
+            except pygame.error as e:
+                logger.error('Could not open audio: {0}'.format(e))
+                self._no_audio = True
+                return False
+            # anything loaded belonged to a mixer that has gone
+            self._sounds = {}
+            resources.cache.discard('sound')
+
+        reserved = sum(self.categories.values())
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), reserved + 2))
+        pygame.mixer.set_reserved(reserved)
+
+        self._voices = {}
+        channel_ids = itertools.count()
+        for category in sorted(self.categories):
+            self._voices[category] = [[pygame.mixer.Channel(next(channel_ids)), 0, 0]
+                                      for _ in range(self.categories[category])]
+
+        for filename in self.preload:
+            self.sound(filename)
+        return True
+
+    def sound(self, filename):
+        try:
+            return self._sounds[filename]
+        except KeyError:
+            sound = self._sounds[filename] = resources.load_sound(filename)
+            return sound
+
+    def play(self, filename, category='effects', priority=0, loops=0):
+        '''Plays a packaged sound on one of category's channels.  Returns the
+        channel, or None if no channel was free or low enough priority.'''
+        if not self.initialized and not self.init():
+            return None
+
+        voices = self._voices[category]
+        voice = None
+        for v in voices:
+            if not v[0].get_busy():
+                voice = v
+                break
+        else:
+            # steal the lowest priority, oldest channel, if below our priority
+            lowest = min(voices, key=lambda v: (v[1], v[2]))
+            if lowest[1] < priority:
+                voice = lowest
+
+        if voice is None:
+            return None
+
+        voice[0].play(self.sound(filename), loops)
+        voice[1] = priority
+        voice[2] = next(self._order)
+        return voice[0]
+
+    def play_music(self, filename):
+        '''Fades the current music out and filename in over the next updates.'''
+        if filename == self._music and not self._fading_out:
+            return
+        if not self.initialized and not self.init():
+            return
+        self._next_music = filename
+        self._fading_out = pygame.mixer.get_init() is not None and pygame.mixer.music.get_busy()
+        if not self._fading_out:
+            self._start_music()
+
+    def _start_music(self):
+        filename, self._next_music = self._next_music, None
+        self._fading_out = False
+        self._music = filename
+        try:
+            pygame.mixer.music.load(resources.get(filename))
+        except pygame.error as e:
+            logger.error('Could not load music {0}: {1}'.format(filename, e))
+            self._music = None
+            return
+        self._music_volume = 0.0
+        pygame.mixer.music.set_volume(0.0)
+        pygame.mixer.music.play(-1)
+
+    def update(self, d_t):
+        '''Steps music fades by d_t ms.'''
+        if not pygame.mixer.get_init():
+            return
+
+        step = self.volume * d_t / float(self.fade_ms)
+        if self._fading_out:
+            self._music_volume -= step
+            if self._music_volume <= 0:
+                pygame.mixer.music.stop()
+                self._start_music()
+            else:
+                pygame.mixer.music.set_volume(self._music_volume)
+        elif self._music is not None and self._music_volume < self.volume:
+            self._music_volume = min(self.volume, self._music_volume + step)
+            pygame.mixer.music.set_volume(self._music_volume)
+
+
+manager = AudioManager()
@@ -1,16 +1,58 @@
+import itertools
+
 import pygame
 
+from spatial import SpatialHash
+
 
 class CameraGroup(pygame.sprite.Group):
+    '''A sprite group that draws only the sprites overlapping the camera.
+
+    Sprites are kept in a spatial hash.  Sprites that move should be passed to
+    moved() (or call refresh() once per frame) so the hash stays current.
+    Overlapping sprites are drawn in the order they were added, later ones on
+    top.'''
     def __init__(self, *args, **kwargs):
+        self._index = SpatialHash(kwargs.pop('cell_size', 128))
+        self._order = {}  # sprite -> when it was added
+        self._count = itertools.count()
         super(CameraGroup, self).__init__(*args, **kwargs)
 
-    def draw(self, surface, camera):
+        self.drawn = 0   # sprites drawn by the last draw
+        self.culled = 0  # sprites skipped by the last draw
+
+    def add_internal(self, sprite):
+        super(CameraGroup, self).add_internal(sprite)
+        if sprite not in self._index:
+            self._index.add(sprite)
+            self._order[sprite] = next(self._count)
+
+    def remove_internal(self, sprite):
+        super(CameraGroup, self).remove_internal(sprite)
+        if sprite in self._index:
+            self._index.remove(sprite)
+            del self._order[sprite]
+
+    def moved(self, sprite):
+        '''Re-indexes a sprite after its rect changed.'''
+        self._index.update(sprite)
+
+    def refresh(self):
+        '''Re-indexes every sprite whose rect changed.'''
+        update = self._index.update
         for sprite in self.sprites():
-            draw_rect = sprite.rect
+            update(sprite)
 
-            if camera.colliderect(draw_rect):
-                draw_rect.x -= camera.x
-                draw_rect.y -= camera.y
+    def draw(self, surface, camera):
+        blit = surface.blit
+        cx, cy = camera.topleft
+        drawn = 0
+        # the hash gives a set, put it back in the order they were added
+        for sprite in sorted(self._index.query(camera), key=self._order.__getitem__):
+            rect = sprite.rect
+            if camera.colliderect(rect):
+                blit(sprite.image, (rect.x - cx, rect.y - cy))
+                drawn += 1
 
-                surface.blit(sprite.image, draw_rect)
+        self.drawn = drawn
+        self.culled = len(self) - drawn
@@ -0,0 +1,207 @@
+import pygame
+
+import logging
+logger = logging.getLogger()
+
+# floor of a Collision layer without a floor property; older maps have one
+# such layer, holding the ground floor's walls
+DEFAULT_COLLISION_FLOOR = 0
+
+
+class CollisionGrid(object):
+    '''A uniform grid of solid cells for a single floor.
+
+    Solid cells are merged into maximal rectangles when the grid is built, and
+    each rectangle is registered in every cell it covers so that queries only
+    look at the cells the query rect touches.'''
+    def __init__(self, cell_width, cell_height):
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+
+        self.solid = set()  # (column, row) of solid cells waiting to be merged
+        self.rects = []     # merged wall rects
+        self.cells = {}     # (column, row) -> list of indices into self.rects
+
+    def add_cell(self, column, row):
+        self.solid.add((column, row))
+
+    def add_rect(self, rect, bounds=None):
+        '''Adds a wall rect.  Grid aligned rects are split into cells so they
+        can merge with their neighbours, anything else is indexed as is.
+        bounds (grid aligned) limits the cells an aligned rect fills, for
+        grids that only cover part of a map.'''
+        cw, ch = self.cell_width, self.cell_height
+        if rect.x % cw or rect.y % ch or rect.width % cw or rect.height % ch:
+            self._index(pygame.Rect(rect))
+            return
+
+        if bounds is not None:
+            rect = rect.clip(bounds)
+        for column in range(rect.x // cw, rect.right // cw):
+            for row in range(rect.y // ch, rect.bottom // ch):
+                self.solid.add((column, row))
+
+    def build(self):
+        '''Merges the solid cells into maximal rectangles and indexes them.'''
+        solid = self.solid
+        cw, ch = self.cell_width, self.cell_height
+
+        # walk cells top to bottom, left to right so each rect starts at its
+        # top left corner
+        for column, row in sorted(solid, key=lambda cell: (cell[1], cell[0])):
+            if (column, row) not in solid:
+                continue
+
+            # grow right as far as the row run goes
+            end = column
+            while (end + 1, row) in solid:
+                end += 1
+
+            # then grow down while the whole run is solid
+            bottom = row
+            while all((c, bottom + 1) in solid for c in range(column, end + 1)):
+                bottom += 1
+
+            for c in range(column, end + 1):
+                for r in range(row, bottom + 1):
+                    solid.discard((c, r))
+
+            self._index(pygame.Rect(column * cw, row * ch,
+                                    (end - column + 1) * cw,
+                                    (bottom - row + 1) * ch))
+
+        self.solid = set()
+
+    def _index(self, rect):
+        idx = len(self.rects)
+        self.rects.append(rect)
+        for key in self._cells_for(rect):
+            self.cells.setdefault(key, []).append(idx)
+
+    def _cells_for(self, rect):
+        cw, ch = self.cell_width, self.cell_height
+        for column in range(rect.left // cw, (rect.right - 1) // cw + 1):
+            for row in range(rect.top // ch, (rect.bottom - 1) // ch + 1):
+                yield column, row
+
+    def collide(self, rect):
+        '''Returns the wall rects colliding with rect.'''
+        cells = self.cells
+        rects = self.rects
+        seen = set()
+        hits = []
+        for key in self._cells_for(rect):
+            for idx in cells.get(key, ()):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                if rect.colliderect(rects[idx]):
+                    hits.append(rects[idx])
+        return hits
+
+
+class RegionCollision(object):
+    '''The walls of one floor of a streamed level, as a CollisionGrid per
+    square region of region_size pixels.  The grids are all built up front;
+    only those of the regions in loaded are queried.'''
+    def __init__(self, region_size):
+        self.region_size = region_size
+        self.grids = {}  # region -> CollisionGrid
+        self.loaded = set()  # regions to query
+
+    def collide(self, rect):
+        '''Returns the wall rects colliding with rect in loaded regions.'''
+        size = self.region_size
+        grids = self.grids
+        loaded = self.loaded
+        hits = []
+        seen = set()
+        for column in range(rect.left // size, (rect.right - 1) // size + 1):
+            for row in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                region = column, row
+                if region not in loaded or region not in grids:
+                    continue
+                for hit in grids[region].collide(rect):
+                    # walls off the grid are in every region they touch
+                    key = tuple(hit)
+                    if key not in seen:
+                        seen.add(key)
+                        hits.append(hit)
+        return hits
+
+
+def collision_cells(tmx_data):
+    '''Yields (floor, column, row) for the solid cells of the "Collision"
+    tile layers.  A Collision layer's floor is its floor property, or
+    DEFAULT_COLLISION_FLOOR if it has none.'''
+    for layer in tmx_data.layers:
+        if getattr(layer, 'name', None) != 'Collision' or not hasattr(layer, 'data'):
+            continue
+        floor = layer.properties.get('floor')
+        if floor is None:
+            logger.info('Collision layer has no floor property, its tiles are walls '
+                        'on floor {0}'.format(DEFAULT_COLLISION_FLOOR))
+            floor = DEFAULT_COLLISION_FLOOR
+        floor = int(floor)
+        for row, line in enumerate(layer.data):
+            for column, gid in enumerate(line):
+                if gid:
+                    yield floor, column, row
+
+
+def build_collision_grids(tmx_data, walls):
+    '''Builds a CollisionGrid per floor from the "Collision" tile layers and
+    the wall rects in walls (floor -> list of rects), see collision_cells.'''
+    grids = {}
+
+    def grid_for(floor):
+        if floor not in grids:
+            grids[floor] = CollisionGrid(tmx_data.tilewidth, tmx_data.tileheight)
+        return grids[floor]
+
+    for floor, column, row in collision_cells(tmx_data):
+        grid_for(floor).add_cell(column, row)
+
+    for floor, rects in walls.items():
+        grid = grid_for(floor)
+        for rect in rects:
+            grid.add_rect(rect)
+
+    for grid in grids.values():
+        grid.build()
+
+    return grids
+
+
+def build_region_collision(tmx_data, region_walls, region_size):
+    '''Builds the same walls as build_collision_grids, split by region for a
+    streamed level: returns floor -> RegionCollision.  region_walls is
+    region -> [(floor, (x, y, w, h))], with each wall under every region it
+    touches.  region_size must be a multiple of the tile size.'''
+    tw, th = tmx_data.tilewidth, tmx_data.tileheight
+    floors = {}
+
+    def grid_for(floor, region):
+        walls = floors.get(floor)
+        if walls is None:
+            walls = floors[floor] = RegionCollision(region_size)
+        grid = walls.grids.get(region)
+        if grid is None:
+            grid = walls.grids[region] = CollisionGrid(tw, th)
+        return grid
+
+    for floor, column, row in collision_cells(tmx_data):
+        region = column * tw // region_size, row * th // region_size
+        grid_for(floor, region).add_cell(column, row)
+
+    for region, walls in region_walls.items():
+        bounds = pygame.Rect(region[0] * region_size, region[1] * region_size,
+                             region_size, region_size)
+        for floor, rect in walls:
+            grid_for(floor, region).add_rect(pygame.Rect(rect), bounds)
+
+    for walls in floors.values():
+        for grid in walls.grids.values():
+            grid.build()
+
+    return floors
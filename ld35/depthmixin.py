@@ -1,69 +1,628 @@
+from bisect import bisect_left, bisect_right
+import itertools
+from timeit import default_timer
+
 from pyscroll import PyscrollGroup
 import pygame
 
+
+def depth_key(s):
+    '''The sort key used to order sprites by depth.'''
+    idx = getattr(s, 'index', None)
+    if idx is not None:
+        return idx(s)
+    return s.rect.center[1] + (getattr(s, 'h', 0) + getattr(s, 'z', 0) << 8)
+
+
+def _index_key(s):
+    return s.index(s)
+
+
+def _height_z_key(s):
+    return s.rect.centery + (s.h + s.z << 8)
+
+
+def _z_key(s):
+    return s.rect.centery + (s.z << 8)
+
+
+def _height_key(s):
+    return s.rect.centery + (s.h << 8)
+
+
+def _flat_key(s):
+    return s.rect.centery
+
+
+def depth_key_for(s):
+    '''Returns a function giving the same key as depth_key for s, without
+    looking up which attributes s has every time it is called.'''
+    if getattr(s, 'index', None) is not None:
+        return _index_key
+    has_h = hasattr(s, 'h')
+    has_z = hasattr(s, 'z')
+    if has_h and has_z:
+        return _height_z_key
+    if has_z:
+        return _z_key
+    if has_h:
+        return _height_key
+    return _flat_key
+
+
+def merge_rects(rects):
+    '''Returns rects with overlapping ones replaced by their union, so no two
+    overlap.'''
+    merged = []
+    for r in rects:
+        r = pygame.Rect(r)
+        i = 0
+        while i < len(merged):
+            if r.colliderect(merged[i]):
+                # the union may now reach rects already passed, start over
+                r.union_ip(merged.pop(i))
+                i = 0
+            else:
+                i += 1
+        merged.append(r)
+    return merged
+
+
+class DepthTracked(object):
+    '''A sprite that tells its DepthMixin group when its depth key may have
+    changed, so the group does not have to work the key out every update.
+    Call moved after changing rect, z or h, and redraw after changing only
+    image or image_offset.'''
+    depth_group = None
+
+    def moved(self):
+        if self.depth_group is not None:
+            self.depth_group.moved(self)
+
+    def redraw(self):
+        if self.depth_group is not None:
+            self.depth_group.redraw(self)
+
+
 class DepthMixin(object):
     '''A mixin for pygame.sprite.Group objects that sorts sprites during update
-    according to z.'''
+    according to z.
+
+    With incremental_sort (the default) each sprite's key is cached, and only
+    sprites that may have moved get a new key and are taken out and put back
+    in order, so the sort costs about as much as the number of sprites that
+    moved.  Those are DepthTracked sprites that called moved, sprites in the
+    store (an EntityStore) that it says changed, and every sprite that is not
+    DepthTracked.  Which attributes go into a sprite's key is worked out when
+    it is added.  Adding sprites or changing their layer reorders the list,
+    so the next update sorts it all again.  Sprites at the same depth are
+    kept in the order they were added, whichever way the list was sorted.
+
+    With a scheduler, only the sprites it has awake are updated.'''
+    # fall back to a full sort when more than this fraction of sprites moved
+    full_sort_ratio = 0.25
+
     def __init__(self, *args, **kwargs):
+        self.incremental_sort = kwargs.pop('incremental_sort', True)
+        self.scheduler = kwargs.pop('scheduler', None)
+        self.store = kwargs.pop('store', None)
+        self._depth_keys = {}  # sprite -> (key, add order) it was last sorted with
+        self._add_order = {}  # sprite -> when it was added, breaks ties
+        self._add_count = itertools.count()
+        self._sorted_keys = []  # the keys in _spritelist order
+        self._key_funcs = {}  # sprite -> depth_key_for(sprite)
+        self._moved = set()  # DepthTracked sprites that called moved
+        self._untracked = set()  # sprites keyed every update
+        self._resort = True  # the list is out of order, sort all of it
+        self.sort_time = 0.0  # ms spent sorting in the last update
         super(DepthMixin, self).__init__(*args, **kwargs)
 
     def update(self, *args, **kwargs):
-        super(DepthMixin, self).update(*args, **kwargs)
+        if self.scheduler is None:
+            super(DepthMixin, self).update(*args, **kwargs)
+        else:
+            self.scheduler.update(*args, **kwargs)
+
+        start = default_timer()
+        if self.incremental_sort:
+            self.sort_sprites()
+        else:
+            self._take_moved()
+            self._spritelist.sort(lambda l, r: depth_key(l) - depth_key(r))
+            self._resort = True
+        self.sort_time = (default_timer() - start) * 1000.0
+
+    def moved(self, sprite):
+        '''Marks sprite to get a new key in the next sort.'''
+        self._moved.add(sprite)
+
+    def redraw(self, sprite):
+        '''Called when only sprite's image changed, which does not change its
+        key.'''
+        pass
+
+    def _take_moved(self):
+        '''Returns the sprites that may have moved since the last call, and
+        {sprite: z} for the ones the store says changed.'''
+        moved = self._moved
+        self._moved = set()
+        stored = self.store.depth_changed() if self.store is not None else {}
+        return moved, stored
+
+    def sort_sprites(self):
+        '''Puts the sprites whose key changed back in order.'''
+        keys = self._depth_keys
+        key_funcs = self._key_funcs
+        add_order = self._add_order
+        spritelist = self._spritelist
+
+        moved, stored = self._take_moved()
+
+        if self._resort:
+            self._resort = False
+            for spr in spritelist:
+                keys[spr] = (key_funcs[spr](spr), add_order[spr])
+            self._full_sort()
+            return
+
+        moved.update(self._untracked)
+        dirty = []  # (sprite, key it is sorted by now)
+
+        # the store has z already, don't read it back one sprite at a time
+        for spr, z in stored.items():
+            key_func = key_funcs.get(spr)
+            if key_func is None:
+                continue
+            old = keys[spr]
+            if key_func is _height_z_key:
+                key = (spr.rect.centery + (spr.h + z << 8), old[1])
+            else:
+                key = (key_func(spr), old[1])
+            if key != old:
+                keys[spr] = key
+                dirty.append((spr, old))
+
+        for spr in moved:
+            key_func = key_funcs.get(spr)
+            if key_func is None:
+                continue
+            old = keys[spr]
+            key = (key_func(spr), old[1])
+            if key != old:
+                keys[spr] = key
+                dirty.append((spr, old))
 
-        def spr_idx(s):
-            idx = getattr(s, 'index', lambda s: s.rect.center[1] + (getattr(s, 'h', 0) +
-                                                                    getattr(s, 'z', 0) << 8))
-            return idx(s)
+        if not dirty:
+            return
+
+        if len(dirty) > len(spritelist) * self.full_sort_ratio:
+            self._full_sort()
+            return
+
+        # find the dirty sprites by their old keys and take them out, last
+        # first so the other indices stay put
+        sorted_keys = self._sorted_keys
+        found = []
+        for spr, old in dirty:
+            i = bisect_left(sorted_keys, old)
+            while spritelist[i] is not spr:
+                i += 1
+            found.append(i)
+        found.sort()
+        dirty = [spritelist[i] for i in found]
+        for i in reversed(found):
+            del spritelist[i]
+            del sorted_keys[i]
+
+        # the rest are still in order, so slot the dirty ones back in; no
+        # two keys are equal, so this is where a full sort puts them
+        for spr in dirty:
+            key = keys[spr]
+            i = bisect_right(sorted_keys, key)
+            sorted_keys.insert(i, key)
+            spritelist.insert(i, spr)
+
+    def _full_sort(self):
+        keys = self._depth_keys
+        self._spritelist.sort(key=keys.__getitem__)
+        self._sorted_keys = [keys[spr] for spr in self._spritelist]
+
+    def add_internal(self, sprite, layer=None):
+        super(DepthMixin, self).add_internal(sprite, layer)
+        self._key_funcs[sprite] = depth_key_for(sprite)
+        self._add_order[sprite] = next(self._add_count)
+        if isinstance(sprite, DepthTracked):
+            sprite.depth_group = self
+        else:
+            self._untracked.add(sprite)
+        # pygame put it in by layer, not by key
+        self._resort = True
+        if self.scheduler is not None:
+            self.scheduler.add(sprite)
+
+    def remove_internal(self, sprite):
+        if not self._resort and sprite in self._depth_keys:
+            # keep the keys lined up with the list pygame removes it from
+            del self._sorted_keys[self._spritelist.index(sprite)]
+        self._depth_keys.pop(sprite, None)
+        self._key_funcs.pop(sprite, None)
+        self._add_order.pop(sprite, None)
+        self._moved.discard(sprite)
+        self._untracked.discard(sprite)
+        if getattr(sprite, 'depth_group', None) is self:
+            sprite.depth_group = None
+        if self.scheduler is not None:
+            self.scheduler.remove(sprite)
+        super(DepthMixin, self).remove_internal(sprite)
+
+    def change_layer(self, sprite, new_layer):
+        # changing layer moves the sprite in the list, so sort it again
+        super(DepthMixin, self).change_layer(sprite, new_layer)
+        self._resort = True
 
-        self._spritelist.sort(lambda l, r: spr_idx(l) - spr_idx(r))
 
 class DepthOrderedScrollGroup(DepthMixin, PyscrollGroup):
+    # how far outside the view a stored sprite's rect may be and still be drawn,
+    # for images bigger than or offset from their rects
+    cull_margin = 32
+    # past this many separate changed areas draw_dirty draws their union once
+    max_dirty_areas = 8
+
     def __init__(self, *args, **kwargs):
         self.debug = kwargs.pop('debug', False)
+        # sprite -> ([image, rect, layer(, blendmode)] handed to pyscroll,
+        #            has z, has image_offset, has hitbox)
+        self._entries = {}
         super(DepthOrderedScrollGroup, self).__init__(*args, **kwargs)
+        self._previous = {}  # sprite -> (x, y, z) before the last simulation step
+        self.map_draw_time = 0.0  # ms spent in the map layer in the last draw
+        self._drawn = {}  # sprite -> ((x, y, w, h), image) from the last draw_dirty
+        self._drawn_view = None  # view, zoom and surface size of the last draw
+        self._removed = []  # where sprites removed since then were drawn
 
-    # note: copied from pyscroll and modified for z drawing
-    def draw(self, surface):
-        """ Draw all sprites and map onto the surface
+        # which entries _sprite_surfaces has to work out again, see moved
+        self._changed = set()  # moved or changed image since the last draw
+        self._stepped = set()  # moved in the last simulation step
+        self._recomputed = []  # sprites whose entries the last draw changed
+        self._entry_view = None  # center offset and scale the entries are at
 
-        :param surface: pygame surface to draw to
+        # with a store only the sprites near the view get entries worked out
+        self._unstored = set()  # sprites not in the store, always drawn
+        self._shown = None  # set of sprites last drawn, None if not culled
+        self._shown_list = []  # the same in draw order
+        self._unshown = []  # sprites culled by the last _sprite_surfaces
+
+    @property
+    def view(self):
+        '''The part of the map in view, in map pixels.'''
+        map_layer = self._map_layer
+        if hasattr(map_layer, 'world_view'):
+            return map_layer.world_view
+        return map_layer.view_rect.copy()
+
+    def add_internal(self, sprite, layer=None):
+        super(DepthOrderedScrollGroup, self).add_internal(sprite, layer)
+        self._make_entry(sprite)
+        # levels put sprites in the store before adding them here
+        if self.store is None or sprite not in self.store:
+            self._unstored.add(sprite)
+
+    def remove_internal(self, sprite):
+        self._entries.pop(sprite, None)
+        self._changed.discard(sprite)
+        self._stepped.discard(sprite)
+        self._unstored.discard(sprite)
+        if self._shown is not None:
+            self._shown.discard(sprite)
+        drawn = self._drawn.pop(sprite, None)
+        if drawn is not None:
+            self._removed.append(drawn[0])
+        super(DepthOrderedScrollGroup, self).remove_internal(sprite)
+
+    def change_layer(self, sprite, new_layer):
+        super(DepthOrderedScrollGroup, self).change_layer(sprite, new_layer)
+        self._make_entry(sprite)
+
+    def _make_entry(self, spr):
+        """ Sets up the reusable draw entry for a sprite, and notes which
+        optional attributes it has so drawing does not have to check
         """
-        ox, oy = self._map_layer.get_center_offset()
+        entry = [spr.image, pygame.Rect(spr.rect), self.get_layer_of_sprite(spr)]
+        if hasattr(spr, 'blendmode'):
+            entry.append(spr.blendmode)
+        self._entries[spr] = (entry, hasattr(spr, 'z'), hasattr(spr, 'image_offset'),
+                              hasattr(spr, 'hitbox'))
+        self._changed.add(spr)
 
-        new_surfaces = list()
-        spritedict = self.spritedict
-        gl = self.get_layer_of_sprite
-        new_surfaces_append = new_surfaces.append
+    def moved(self, sprite):
+        super(DepthOrderedScrollGroup, self).moved(sprite)
+        self._changed.add(sprite)
+        self._stepped.add(sprite)
 
-        debug_rects = []
+    def redraw(self, sprite):
+        self._changed.add(sprite)
 
+    def _take_moved(self):
+        # the store does not call moved, this is where its changes turn up
+        moved, stored = super(DepthOrderedScrollGroup, self)._take_moved()
+        changed = moved
+        if stored:
+            # the hidden ones are worked out when they come into view
+            shown = self._shown
+            changed = moved.union(stored if shown is None else shown.intersection(stored))
+        self._changed.update(changed)
+        self._stepped.update(changed)
+        return moved, stored
+
+    def save_positions(self):
+        '''Remembers where every sprite is, so draw can interpolate between
+        this and the next simulation step.'''
+        entries = self._entries
+        previous = {}
         for spr in self.sprites():
-            new_rect = spr.rect.move(ox, oy - getattr(spr, 'z', 0))
-            if self.debug:
-                debug_rects.append(new_rect)
-                if hasattr(spr, 'hitbox'):
-                    debug_rects.append(spr.hitbox.move(ox, oy - getattr(spr, 'z', 0)))
-
-            if hasattr(spr, 'image_offset'):
-                # not move_ip because we need debug_rect to remain un-moved
-                new_rect = new_rect.move(spr.image_offset)
-
-            try:
-                new_surfaces_append((spr.image, new_rect, gl(spr), spr.blendmode))
-            except AttributeError:  # generally should only fail when no blendmode available
-                new_surfaces_append((spr.image, new_rect, gl(spr)))
-            spritedict[spr] = new_rect
+            r = spr.rect
+            previous[spr] = (r.x, r.y, spr.z if entries[spr][1] else 0)
+        self._previous = previous
+        # what moved in the step before has to be drawn where it ended up
+        self._changed.update(self._stepped)
+        self._stepped = set()
+
+    def invalidate(self):
+        '''Makes the next draw_dirty draw everything.'''
+        self._drawn_view = None
 
+    # note: copied from pyscroll and modified for z drawing
+    def draw(self, surface, alpha=None):
+        """ Draw all sprites and map onto the surface
+
+        :param surface: pygame surface to draw to
+        :param alpha: if given, draw sprites this fraction of the way from
+            their saved positions to their current ones
+        """
+        new_surfaces = self._sprite_surfaces(alpha)
+
+        start = default_timer()
         ret = self._map_layer.draw(surface, surface.get_rect(), new_surfaces)
+        self.map_draw_time = (default_timer() - start) * 1000.0
 
         # debug
         if self.debug:
-            zoom = self._map_layer._zoom_level
-            for r in debug_rects:
-                r.x *= zoom
-                r.y *= zoom
-                r.width *= zoom
-                r.height *= zoom
-                pygame.draw.rect(surface, (200, 100, 100), r, 1)
+            self._draw_debug(surface)
 
         return ret
+
+    def draw_dirty(self, surface, alpha=None, rects=()):
+        """ Draw only the parts of the screen where sprites changed
+
+        Falls back to a full draw when the view scrolled or zoomed, tiles are
+        animated or debug drawing is on.
+
+        :param surface: pygame surface to draw to
+        :param alpha: as for draw
+        :param rects: screen rects to draw again as well, such as where text
+            drawn over the map changed
+        :return: list of changed screen rects, or None after a full draw
+        """
+        map_layer = self._map_layer
+        view = (tuple(map_layer.view_rect), map_layer.zoom, surface.get_size())
+        old = self._drawn
+
+        if view != self._drawn_view or self.debug or map_layer._animation_queue:
+            self._drawn_view = view
+            self.draw(surface, alpha)
+            entries = self._entries
+            drawn = self._drawn = {}
+            for spr in self._shown_list:
+                entry = entries[spr][0]
+                drawn[spr] = (tuple(entry[1]), entry[0])
+            self._removed = []
+            return None
+
+        new_surfaces = self._sprite_surfaces(alpha)
+
+        # anything that moved, changed image or went away, old and new spots.
+        # Only entries _sprite_surfaces worked out again can have changed.
+        entries = self._entries
+        dirty = [pygame.Rect(rect) for rect in self._removed]
+        self._removed = []
+        for spr in self._unshown:
+            last = old.pop(spr, None)
+            if last is not None:
+                dirty.append(pygame.Rect(last[0]))
+        for spr in self._recomputed:
+            entry = entries[spr][0]
+            rect = tuple(entry[1])
+            image = entry[0]
+            last = old.get(spr)
+            if last is None:
+                dirty.append(pygame.Rect(rect))
+            elif last[1] is not image or last[0] != rect:
+                dirty.append(pygame.Rect(rect))
+                dirty.append(pygame.Rect(last[0]))
+            else:
+                continue
+            old[spr] = (rect, image)
+
+        if not dirty and not rects:
+            self.map_draw_time = 0.0
+            return []
+
+        start = default_timer()
+        zoom = map_layer._zoom_level
+        if zoom == 1.0:
+            # pyscroll clips to the rect it is given, so draw onto each changed
+            # area only, with the sprites over it shifted into its coordinates.
+            # Areas far apart are drawn apart, not as one big union.
+            areas = merge_rects(dirty + list(rects))
+            if len(areas) > self.max_dirty_areas:
+                areas = [areas[0].unionall(areas[1:])]
+            screen = surface.get_rect()
+            full = pygame.Rect(0, 0, surface.get_width(), surface.get_height())
+            screen_rects = []
+            for area in areas:
+                area = area.clip(screen)
+                if not area.width or not area.height:
+                    continue
+                shifted = [[i[0], i[1].move(-area.x, -area.y)] + i[2:]
+                           for i in new_surfaces if i[1].colliderect(area)]
+                map_layer.draw(surface.subsurface(area), full.move(-area.x, -area.y),
+                               shifted)
+                screen_rects.append(area)
+        else:
+            # render the small buffer, then scale up only the changed parts
+            buff = map_layer._zoom_buffer
+            map_layer._render_map(buff, buff.get_rect(), new_surfaces)
+            sx = surface.get_width() / float(buff.get_width())
+            sy = surface.get_height() / float(buff.get_height())
+            for r in rects:
+                dirty.append(pygame.Rect(int(r.x / sx), int(r.y / sy),
+                                         int(r.width / sx) + 1, int(r.height / sy) + 1))
+            buff_rect = buff.get_rect()
+            screen = surface.get_rect()
+            screen_rects = []
+            for r in dirty:
+                r = r.inflate(2, 2).clip(buff_rect)
+                if not r.width or not r.height:
+                    continue
+                s = pygame.Rect(int(r.x * sx), int(r.y * sy),
+                                int(r.right * sx) - int(r.x * sx),
+                                int(r.bottom * sy) - int(r.y * sy)).clip(screen)
+                map_layer.scaling_function(buff.subsurface(r), s.size,
+                                           surface.subsurface(s))
+                screen_rects.append(s)
+        self.map_draw_time = (default_timer() - start) * 1000.0
+
+        return screen_rects
+
+    def _sprite_surfaces(self, alpha):
+        """ Updates the draw entries in place and returns them in draw order
+
+        The entries and their rects are reused from frame to frame, and only
+        worked out again for sprites that moved or changed image (see moved
+        and redraw), are still between two steps (with alpha), or are not
+        DepthTracked.  When only the view moved the other entries are shifted
+        along with it.  Sprites in the store that are out of view are left
+        out without being looked at, and worked out again when they come back
+        into view.  With a ScaledRenderer images come from its cache and rects
+        are scaled to match.
+        """
+        map_layer = self._map_layer
+        ox, oy = map_layer.get_center_offset()
+        previous = self._previous if alpha is not None else None
+        entries = self._entries
+        spritedict = self.spritedict
+
+        scale = 1
+        scaled_image = None
+        image_cache = getattr(map_layer, 'image_cache', None)
+        if image_cache is not None:
+            scale = image_cache.zoom
+            scaled_image = image_cache.get
+
+        # the store's sprites near the view and the rest, in draw order
+        last_shown = self._shown
+        store = self.store
+        if store is not None and len(store):
+            margin = self.cull_margin
+            sprites = store.overlapping(self.view.inflate(margin * 2, margin * 2))
+            sprites.extend(self._unstored)
+            shown = set(sprites)
+            if self._resort:
+                # the list is not sorted yet, take them out of it in its order
+                sprites = [spr for spr in self.sprites() if spr in shown]
+            else:
+                # the list is in key order, so the keys give the same order
+                sprites.sort(key=self._depth_keys.__getitem__)
+            if last_shown is None:
+                self._unshown = [spr for spr in self._drawn if spr not in shown]
+            else:
+                self._unshown = list(last_shown - shown)
+        else:
+            sprites = self.sprites()
+            shown = None
+            self._unshown = []
+        self._shown = shown
+        self._shown_list = sprites
+
+        last_view = self._entry_view
+        self._entry_view = ox, oy, scale
+        shift = False
+        if last_view is None or last_view[2] != scale or (last_shown is not None
+                                                          and shown is None):
+            redo = None  # all of them
+        else:
+            redo = self._changed | self._untracked
+            if alpha is not None:
+                redo |= self._stepped
+            else:
+                self._stepped.clear()
+            if last_view[:2] != (ox, oy):
+                shift = True
+                dx = (ox - last_view[0]) * scale
+                dy = (oy - last_view[1]) * scale
+
+        # hidden sprites are not kept in _changed, coming back into view
+        # works them out again anyway
+        self._changed = set()
+        recomputed = self._recomputed = []
+        new_surfaces = []
+        new_surfaces_append = new_surfaces.append
+        for spr in sprites:
+            if (redo is not None and spr not in redo
+                    and (last_shown is None or spr in last_shown)):
+                entry = entries[spr][0]
+                if shift:
+                    entry[1].move_ip(dx, dy)
+                new_surfaces_append(entry)
+                continue
+            entry, has_z, has_offset, _ = entries[spr]
+            r = spr.rect
+            z = spr.z if has_z else 0
+            x = r.x + ox
+            y = r.y + oy - z
+            if previous is not None and spr in previous:
+                px, py, pz = previous[spr]
+                x += int((px - r.x) * (1 - alpha))
+                y += int((py - r.y - pz + z) * (1 - alpha))
+
+            if has_offset:
+                offset = spr.image_offset
+                if offset is not None:
+                    x += offset[0]
+                    y += offset[1]
+
+            image = spr.image
+            if scaled_image is not None:
+                image = scaled_image(image)
+                x *= scale
+                y *= scale
+            rect = entry[1]
+            rect.x = x
+            rect.y = y
+            rect.size = image.get_size()
+            entry[0] = image
+            new_surfaces_append(entry)
+            spritedict[spr] = rect
+            recomputed.append(spr)
+
+        return new_surfaces
+
+    def _draw_debug(self, surface):
+        """ Outlines sprite rects and hitboxes, scaled to the zoom level
+        """
+        ox, oy = self._map_layer.get_center_offset()
+        zoom = self._map_layer.zoom
+        debug_rects = []
+        for spr in self.sprites():
+            _, has_z, _, has_hitbox = self._entries[spr]
+            z = spr.z if has_z else 0
+            debug_rects.append(spr.rect.move(ox, oy - z))
+            if has_hitbox:
+                debug_rects.append(spr.hitbox.move(ox, oy - z))
+
+        for r in debug_rects:
+            r.x *= zoom
+            r.y *= zoom
+            r.width *= zoom
+            r.height *= zoom
+            pygame.draw.rect(surface, (200, 100, 100), r, 1)
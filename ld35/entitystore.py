@@ -0,0 +1,155 @@
+'''Keeps rect extents, z, floor and platform height for many entities in NumPy
+arrays, so platforms can be stepped and entities culled all at once instead of
+one Python object at a time.
+
+NumPy is optional.  Without it `available` is False and levels keep these
+values on the sprites as usual.'''
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+available = numpy is not None
+
+
+class EntityStore(object):
+    '''Rows of entity data in contiguous arrays.
+
+    An added entity gets store and row attributes; entities that support it
+    (see gameobjects.RisingPlatform) then read and write z, floor and height
+    through the store, with set.  Call moved() after changing an entity's
+    rect.'''
+    # depth_z is z as of the last depth_changed call, stepping is 1 while
+    # height is not at the floor
+    columns = ('x', 'y', 'w', 'h', 'z', 'floor', 'height', 'depth_z', 'stepping')
+
+    def __init__(self, capacity=256):
+        self.entities = []  # row -> entity
+        self.members = set()
+        self.moving = set()  # entities whose height is not at their floor yet
+        self._moved = set()  # entities whose rect changed since depth_changed
+        for name in self.columns:
+            setattr(self, name, numpy.zeros(capacity, numpy.int32))
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, entity):
+        return entity in self.members
+
+    def _grow(self):
+        for name in self.columns:
+            old = getattr(self, name)
+            new = numpy.zeros(len(old) * 2, old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, entity):
+        row = len(self.entities)
+        if row == len(self.x):
+            self._grow()
+
+        # take the values the entity has now, then hand it over to the store
+        self.z[row] = getattr(entity, 'z', 0)
+        self.floor[row] = getattr(entity, 'floor', 0)
+        self.height[row] = getattr(entity, 'height', 0)
+        self.depth_z[row] = self.z[row]
+        self.entities.append(entity)
+        self.members.add(entity)
+        entity.store = self
+        entity.row = row
+        self._update_moving(entity)
+        self.moved(entity)
+
+    def remove(self, entity):
+        '''Removes entity, leaving its current values on it.'''
+        row = entity.row
+        z, floor, height = int(self.z[row]), int(self.floor[row]), int(self.height[row])
+
+        # move the last row into the gap
+        last = len(self.entities) - 1
+        moved = self.entities.pop()
+        if moved is not entity:
+            self.entities[row] = moved
+            for name in self.columns:
+                column = getattr(self, name)
+                column[row] = column[last]
+            moved.row = row
+        self.members.discard(entity)
+        self.moving.discard(entity)
+        self._moved.discard(entity)
+
+        entity.store = None
+        entity.row = None
+        entity.z = z
+        entity.floor = floor
+        entity.height = height
+
+    def set(self, entity, name, value):
+        '''Sets column name (z, floor or height) of entity's row.'''
+        getattr(self, name)[entity.row] = value
+        if name != 'z':
+            self._update_moving(entity)
+
+    def _update_moving(self, entity):
+        row = entity.row
+        moving = self.height[row] != self.floor[row] * 32
+        self.stepping[row] = moving
+        if moving:
+            self.moving.add(entity)
+        else:
+            self.moving.discard(entity)
+
+    def moved(self, entity):
+        row = entity.row
+        r = entity.rect
+        self.x[row] = r.x
+        self.y[row] = r.y
+        self.w[row] = r.width
+        self.h[row] = r.height
+        self._moved.add(entity)
+
+    def depth_changed(self):
+        '''Returns {entity: z} for the entities whose rect or z changed since
+        the last call, i.e. those whose depth sort key may have changed.'''
+        n = len(self.entities)
+        rows = numpy.flatnonzero(self.z[:n] != self.depth_z[:n])
+        self.depth_z[:n] = self.z[:n]
+        entities = self.entities
+        changed = dict(zip([entities[i] for i in rows], self.z[rows].tolist()))
+        for entity in self._moved:
+            changed[entity] = int(self.z[entity.row])
+        self._moved = set()
+        return changed
+
+    def step_platforms(self):
+        '''Moves every platform's height one step towards its floor, and its z
+        along with it, like RisingPlatform.update does for a single one.'''
+        n = len(self.entities)
+        height = self.height[:n]
+        target = self.floor[:n] * 32
+        height += height < target
+        height -= height > target
+        self.z[:n] = height
+
+        # only the platforms that just got there leave the moving set
+        if self.moving:
+            stepping = self.stepping[:n]
+            arrived = numpy.flatnonzero(stepping & (height == target))
+            stepping[arrived] = 0
+            entities = self.entities
+            self.moving.difference_update([entities[i] for i in arrived])
+
+    def _overlap(self, rect, lift):
+        n = len(self.entities)
+        x, y, w, h = self.x[:n], self.y[:n], self.w[:n], self.h[:n]
+        if lift:
+            y = y - self.z[:n]
+        return ((x < rect.right) & (x + w > rect.left) &
+                (y < rect.bottom) & (y + h > rect.top))
+
+    def overlapping(self, rect, lift=True):
+        '''Returns the entities whose rect overlaps rect.  With lift, rects
+        are raised by z, as they are when drawn.'''
+        entities = self.entities
+        return [entities[i] for i in numpy.flatnonzero(self._overlap(rect, lift))]
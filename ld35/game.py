@@ -1,22 +1,29 @@
+import os
+import time
+
 import pygame
 from pygame import Rect
 
-from pytmx.util_pygame import load_pygame
-import pyscroll
-
-#from pyscroll import PyscrollGroup
-from depthmixin import DepthOrderedScrollGroup as PyscrollGroup
-
+import audio
+import mapcache
+import replay
 import resources
-import gameobjects
+import hud
+from hud import Hud
+from level import Level, LevelLoader, map_assets
+from profiler import FrameProfiler, StartupProfiler
 
 import logging
 logger = logging.getLogger()
 
 
 class Game:
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, headless=False, use_map_cache=True, streaming=False,
+                 entity_store=False, prescaled=True, startup=None):
+        # how long each stage of starting up takes, see StartupProfiler
+        self.startup = startup if startup is not None else StartupProfiler()
         self._running = True
+        self.headless = headless
         self._display_surf = None
         self.size = self.width, self.height = 1280, 720
 
@@ -28,116 +35,127 @@ class Game:
         self._clock = pygame.time.Clock()
         self.fps = 60
 
+        # used when fixed_step is set: simulation steps and draws per second, and how
+        # many steps one frame may run to catch up before dropping time
+        self.sim_rate = 60
+        self.render_rate = 60
+        self.max_catchup_steps = 5
+        self.fixed_step = False
+
+        # only redraw and update the screen where sprites changed while the
+        # camera is still, rather than flipping the whole screen every frame
+        self.dirty_rendering = False
+
+        self.profiler = FrameProfiler()
+        self.profile_csv = None  # if set, the profile is written here on exit
+        self.recorder = None  # a replay.Recorder while recording, see record()
+
+        # floor, switches and fps drawn over the game, see update_hud
+        self.hud = Hud(self.size)
+        self.hud_fps_interval = 0.5  # seconds between fps readings
+        self._hud_fps_time = None
+        self._hud_values = None  # floor and switch counts the HUD shows
+
         self.updateables = []
         self.drawables = []
 
-        pygame.init()
-        self._display_surf = pygame.display.set_mode(self.size, pygame.HWSURFACE | pygame.DOUBLEBUF)
+        # passed to every Level; with streaming only the regions around the
+        # player are active, see Level
+        self.level_options = {'use_map_cache': use_map_cache, 'streaming': streaming,
+                              'entity_store': entity_store, 'prescaled': prescaled}
+        self._loader = None  # LevelLoader for the level being preloaded
+
+        # decode the map's images and read its sounds while the window opens
+        cache_data = mapcache.load_data(filename) if use_map_cache else None
+        resources.preload(*map_assets(filename, cache_data))
+        self.startup.lap('preload')
+
+        # fonts and the mixer are set up when first used, not here
+        # the drivers this replaced, put back by on_cleanup
+        self._saved_drivers = None
+        if headless:
+            # no window or sound card needed, e.g. on CI
+            self._saved_drivers = {}
+            for name in ('SDL_VIDEODRIVER', 'SDL_AUDIODRIVER'):
+                self._saved_drivers[name] = os.environ.get(name)
+                os.environ[name] = 'dummy'
+        pygame.display.init()
+        # without an icon set_mode loads pygame's, importing pkg_resources
+        pygame.display.set_icon(resources.pygame_icon())
+        if headless:
+            # the dummy driver defaults to 8 bit, ask for what a real display has
+            self._display_surf = pygame.display.set_mode(self.size, 0, 32)
+        else:
+            self._display_surf = pygame.display.set_mode(self.size, pygame.HWSURFACE | pygame.DOUBLEBUF)
         self._running = True
         self.ignore_walls = False
+        self.startup.lap('display')
 
-        # Load map data
-        tmx_data = load_pygame(filename)
-
-        pygame.mixer.init()
-        musicfile = tmx_data.properties.get('music')
-        if musicfile:
-            self.play_music(musicfile)
-
-        map_data = pyscroll.data.TiledMapData(tmx_data)
-        self.map_layer = pyscroll.BufferedRenderer(map_data, self._display_surf.get_size())
-        self.map_layer.zoom = 4
-        self.group = PyscrollGroup(map_layer=self.map_layer, default_layer=2)
-        # really the group can be added as a gameobject
-
-        self.teleport_group = pygame.sprite.Group()
-
-        # setup level geometry with simple pygame rects, loaded from pytmx
-        self.walls = {} # key is floor, value is list of wall rects
-
-        self.trigger_targets = {}  # targets by target ID
-        self.waiting_triggers = {} # lists of trigger targets by target ID
-        self.triggers = []
-
-        # Find known object types and attach behavior
-        for o in tmx_data.objects:
-            if hasattr(gameobjects, o.type):
-                klass = getattr(gameobjects, o.type)
-                if hasattr(klass, 'from_tmx'):
-                    game_object = klass.from_tmx(o)
-                    game_object.id = int(o.id)
-                    game_object.z = 0
-                    game_object.h = 0
-                    floor = int(o.properties.get('floor', 0))
-                    game_object.floor = floor
-                    if hasattr(o, 'target_id'):
-                        game_object.target_id = getattr(o, 'target_id')
-                    self.group.add(game_object)
-
-                    if o.name == 'Player':
-                        self.player = game_object
-                        self.player.h = 16
-                        self.player.add_floor_listener(self.sprite_layer_handler)
-
-                    if isinstance(game_object, gameobjects.TriggerMixin):
-                        self.add_trigger(game_object)
-
-                    self.save_trigger_target(game_object)
-
-            elif o.type == 'Wall':
-                floor = int(o.properties.get('floor', 0))
-                if not self.walls.has_key(floor):
-                    self.walls[floor] = []
-
-                self.walls[floor].append(pygame.Rect(
-                    o.x, o.y,
-                    o.width, o.height))
-            else:
-                logger.error('Unrecognized object type: {0}'.format(o.type))
-
-        self.group.center(self.player.rect.center)
+        level = Level(filename, self._display_surf.get_size(), cache_data=cache_data,
+                      **self.level_options)
+        self.startup.lap('level')
+        self.set_level(level)
+        self.startup.lap('music')
 
         self.camera_shakes = 0
         self.camera_shake_dist = 0
 
-    def sprite_layer_handler(self, sender):
-        logger.debug('change sprite {0} to layer: {1}'.format(sender, sender.layer))
-        self.group.change_layer(sender, sender.layer)
+    # how many steps the camera takes to close most of the gap to the player
+    camera_smooth_factor = 10
 
-    def save_trigger_target(self, target):
-        # Track all objects as possible trigger targets
-        self.trigger_targets[target.id] = target
+    def set_level(self, level):
+        '''Switches to a loaded Level.  Must be called on the main thread.'''
+        self.level = level
+        self.tmx_data = level.tmx_data
+        self.map_layer = level.map_layer
+        self.group = level.group
+        self.player = level.player
 
-        # Complete any triggers waiting for this target
-        logger.debug('waiting triggers: {0}'.format(self.waiting_triggers))
-        if target.id in self.waiting_triggers:
-            for trigger in self.waiting_triggers[target.id]:
-                trigger.target = target
-                logger.debug('Completing trigger {0} with target: {1}/{2}'.format(trigger.id, target.id, target))
-        else:
-            logger.debug('Failed to find triggers for target: {0}, {1}'.format(target.id, target))
+        self.walls = level.walls
+        self.collision = level.collision
+        self.pushable = level.pushable
 
-    def add_trigger(self, game_object):
-        self.triggers.append(game_object)
+        self.trigger_targets = level.trigger_targets
+        self.waiting_triggers = level.waiting_triggers
+        self.triggers = level.triggers
+        self.trigger_hash = level.trigger_hash
+        self.trigger_order = level.trigger_order
+        self.collision_pair_checks = 0  # hotspot/trigger tests last frame
 
-        if hasattr(game_object, 'target_id') and game_object.target_id is not None:
-            target_id = game_object.target_id
-            if target_id == 'self':
-                target_id = int(game_object.id)
-            else:
-                target_id = int(target_id)
+        self.camera.center = self.player.position
+        # where the view is centred, now and before the last step, see step_camera
+        self._camera_pos = self._camera_prev = tuple(self.player.rect.center)
+        if level.music and not self.headless:
+            self.play_music(level.music)
+
+    def preload_level(self, filename):
+        '''Starts loading filename on a worker thread while the current level
+        keeps running.'''
+        if self._loader is not None and self._loader.filename == filename:
+            return
+        self._loader = LevelLoader(filename, self._display_surf.get_size(), **self.level_options)
+        self._loader.start()
 
-            # hook it up if we can
-            game_object.target = self.trigger_targets.get(target_id, None)
-            logger.debug('Adding trigger {0} with target: {1}/{2}'.format(game_object.id,
-                                                                            target_id,
-                                                                            game_object.target))
+    def change_level(self, filename):
+        '''Switches to filename on the first frame after it has loaded,
+        preloading it first if needed.'''
+        self.preload_level(filename)
+        self._loader.swap = True
 
-            # store it for later if not
-            t = self.waiting_triggers.get(target_id, [])
-            t.append(game_object)
-            self.waiting_triggers[target_id] = t
+    def poll_level(self):
+        loader = self._loader
+        if loader is not None and loader.swap and loader.done:
+            self._loader = None
+            self.set_level(loader.result())
 
+    def add_trigger(self, game_object):
+        self.level.add_trigger(game_object)
+
+    @property
+    def active_count(self):
+        '''How many sprites are awake and being updated.'''
+        scheduler = self.group.scheduler
+        return len(scheduler) if scheduler is not None else len(self.group)
 
     def add_game_object(self, game_object):
         if hasattr(game_object, 'update'):
@@ -147,11 +165,9 @@ class Game:
             self.drawables.append(game_object)
 
     def play_music(self, filename):
-        # Ideally we want to load new music when going into a new map.
-        # Note: pygame's fadeout is blocking so will have to do setvolume over many updates then load the new clip
+        # fades over the next on_loops, so changing maps does not stall
         self._musicfile = filename
-        pygame.mixer.music.load(resources.get(self._musicfile))
-        pygame.mixer.music.play(-1)
+        audio.manager.play_music(filename)
 
     def on_event(self, event):
         if event.type == pygame.QUIT:
@@ -170,29 +186,44 @@ class Game:
             if event.key == pygame.K_t:
                 self.ignore_walls = not self.ignore_walls
                 logger.debug('ignore_walls is {0}'.format(self.ignore_walls))
+            if event.key == pygame.K_p:
+                self.profiler.visible = not self.profiler.visible
+            if event.key == pygame.K_h:
+                self.hud.visible = not self.hud.visible
 
         self.player.on_event(event)
-
-    def on_loop(self):
-        d_t = self._clock.tick(self.fps)
+        if self.recorder is not None:
+            self.recorder.event(event)
+
+    def on_loop(self, d_t=None):
+        if d_t is None:
+            d_t = self._clock.tick(self.fps)
+        self.poll_level()
+        self.level.stream(self.player.rect.center)
+        audio.manager.update(d_t)
         for updateable in self.updateables:
             updateable.update(d_t)
 
         self.camera.center = self.player.position
 
+        if self.level.store is not None:
+            self.level.store.step_platforms()
         self.group.update(d_t)
 
         # check if the sprite's feet are colliding with wall
         # sprite must have a rect called feet, and move_back method,
         # otherwise this will fail
-        # Can use a new group to hold all player sprites if needed
-        # for sprite in self.group.sprites():
+        # only the walls in the grid cells each sprite touches are tested
         if not self.ignore_walls:
-            floor_walls = self.walls.get(self.player.floor, [])
-            collision_list = self.player.rect.collidelistall(floor_walls)
-            if len(collision_list) > 0:
-                wall_list = [floor_walls[i] for i in collision_list]
-                self.player.move_back(wall_list)
+            collision = self.collision
+            for sprite in self.pushable:
+                grid = collision.get(sprite.floor)
+                if grid is not None:
+                    wall_list = grid.collide(sprite.rect)
+                    if len(wall_list) > 0:
+                        sprite.move_back(wall_list)
+
+        self.step_camera()
 
         # Camera shake
         if self.camera_shakes > 0:
@@ -201,50 +232,208 @@ class Game:
         elif self.camera_shakes == 0 and self.camera_shake_dist != 0:
             self.camera_shake_dist = 0
 
+    def step_camera(self):
+        '''Eases the view a step towards the player.  Done once per
+        simulation step, so the camera moves at the same speed whatever the
+        render rate.'''
+        self._camera_prev = c_pos = self._camera_pos
+        c_tgt = self.player.rect.center
+        factor = self.camera_smooth_factor
+        self._camera_pos = (c_pos[0] + (c_tgt[0] - c_pos[0]) / factor,
+                            c_pos[1] + (c_tgt[1] - c_pos[1]) / factor)
+
     def on_collide(self):
+        self.collision_pair_checks = 0
         if self.ignore_walls:
             return
-        for sprite in self.group.sprites():
-            trigger_rects = [x.rect for x in self.triggers]
+
+        # only the triggers that said they moved are bucketed again
+        trigger_hash = self.trigger_hash
+        trigger_hash.update_moved()
+
+        trigger_order = self.trigger_order
+        pair_checks = 0
+        # sleeping sprites are far from the player, nothing they touch matters
+        scheduler = self.group.scheduler
+        sprites = list(scheduler.awake) if scheduler is not None else self.group.sprites()
+        for sprite in sprites:
             spr_r = sprite.rect
             hotspot = spr_r.inflate(-spr_r.width / 4, -spr_r.height / 4)
-            trigger_collision_list = hotspot.collidelistall(trigger_rects)
-            if len(trigger_collision_list) > 0:
-                collider = self.triggers[trigger_collision_list[0]]  # Just get the first index
+            collider = None
+            for trigger in trigger_hash.query(hotspot):
+                pair_checks += 1
+                if hotspot.colliderect(trigger.rect):
+                    # keep the first trigger in load order, like collidelistall did
+                    if collider is None or trigger_order[trigger] < trigger_order[collider]:
+                        collider = trigger
+            if collider is not None:
                 collider.on_collision(sprite)
+        self.collision_pair_checks = pair_checks
 
-    def on_draw(self):
+    def on_draw(self, alpha=None):
         # self._display_surf.fill((0, 0, 0))
 
-        camera_smooth_factor = 10
-        c_pos = self.group.view.center
-        c_tgt = self.player.rect.center
-        distance_x = c_pos[0] + (c_tgt[0] - c_pos[0]) / camera_smooth_factor
-        distance_y = c_pos[1] + (c_tgt[1] - c_pos[1]) / camera_smooth_factor
+        # between the last two steps, like the sprites, so they do not jitter
+        # against each other
+        x, y = self._camera_pos
+        if alpha is not None:
+            px, py = self._camera_prev
+            x += int((px - x) * (1 - alpha))
+            y += int((py - y) * (1 - alpha))
 
-        self.group.center((distance_x + self.camera_shake_dist, distance_y))
+        self.group.center((x + self.camera_shake_dist, y))
 
-        self.group.draw(self._display_surf)
+        self.update_hud()
+
+        if self.dirty_rendering:
+            # the map under text that changed has to be drawn again too
+            dirty_rects = self.group.draw_dirty(self._display_surf, alpha, self.hud.dirty)
+        else:
+            self.group.draw(self._display_surf, alpha)
+            dirty_rects = None
 
         for drawable in self.drawables:
             drawable.draw(self._display_surf, self.camera)
 
-        pygame.display.flip()
+        self.hud.draw(self._display_surf)
+
+        if self.profiler.visible:
+            self.profiler.draw(self._display_surf)
+
+        if dirty_rects is None or self.drawables or self.profiler.visible:
+            pygame.display.flip()
+        else:
+            pygame.display.update(dirty_rects)
+
+    def update_hud(self):
+        '''Sets the HUD lines.  Only lines whose text changed are drawn again.'''
+        hud = self.hud
+        if not hud.visible:
+            return
+        # a reading every frame would make the text flicker and keep redrawing
+        now = time.time()
+        if self._hud_fps_time is None or now - self._hud_fps_time >= self.hud_fps_interval:
+            self._hud_fps_time = now
+            hud.set_text('fps', 'fps {0:.0f}'.format(self._clock.get_fps()))
+        level = self.level
+        values = self.player.floor, level.active_switches, len(level.switches)
+        if values != self._hud_values:
+            self._hud_values = values
+            hud.set_text('floor', 'floor {0}'.format(values[0]))
+            hud.set_text('switches', 'switches {0}/{1}'.format(*values[1:]))
+
+    def record(self, filename):
+        '''Records keys and steps from now on to filename, see replay.'''
+        self.recorder = replay.Recorder(filename, self.level.filename)
+
+    def on_step(self, d_t):
+        '''Called after each simulation step.'''
+        if self.recorder is not None:
+            self.recorder.step(d_t, self)
 
     def on_cleanup(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.profile_csv:
+            self.profiler.dump_csv(self.profile_csv)
+        # sounds and fonts do not survive quitting, the next Game loads them again
+        audio.manager.reset()
+        hud.discard_fonts()
+        resources.cache.discard('font')
+        resources.cache.discard('sound')
         pygame.quit()
+        if self._saved_drivers is not None:
+            # so a later Game that is not headless gets the real drivers
+            for name, value in self._saved_drivers.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            self._saved_drivers = None
 
     def camera_shake(self, shakes=32, dist=4):
         self.camera_shakes = shakes
         self.camera_shake_dist = dist
 
+    def run_headless(self, frames, d_t=1000.0 / 60):
+        '''Steps the simulation frames times with a fixed d_t (in ms) as fast
+        as possible, without drawing.  Returns the simulated frames per second,
+        counting only the frames run if the game quit early.'''
+        start = time.time()
+        stepped = 0
+        for _ in range(frames):
+            for event in pygame.event.get():
+                self.on_event(event)
+            if not self._running:
+                break
+            self.on_loop(d_t)
+            self.on_collide()
+            self.on_step(d_t)
+            stepped += 1
+        elapsed = time.time() - start
+        return stepped / elapsed if elapsed > 0 else float('inf')
+
+    def run_fixed(self):
+        '''Runs the game with the simulation stepped at sim_rate and drawing
+        at render_rate, interpolating sprites between the last two steps.'''
+        profiler = self.profiler
+        step = 1000.0 / self.sim_rate
+        accumulator = 0.0
+        self._clock.tick()
+        while self._running:
+            accumulator += self._clock.tick(self.render_rate)
+            profiler.begin_frame()
+            for event in pygame.event.get():
+                self.on_event(event)
+            profiler.lap('events')
+
+            steps = 0
+            while accumulator >= step and steps < self.max_catchup_steps:
+                self.group.save_positions()
+                self.on_loop(step)
+                profiler.lap('on_loop')
+                profiler.add('depth_sort', self.group.sort_time)
+                self.on_collide()
+                profiler.lap('on_collide')
+                self.on_step(step)
+                accumulator -= step
+                steps += 1
+
+            # too far behind, drop the time rather than spiral
+            if accumulator >= step:
+                accumulator = 0.0
+
+            self.on_draw(accumulator / step)
+            profiler.lap('draw')
+            profiler.add('map_draw', self.group.map_draw_time)
+            profiler.end_frame(steps=steps, sprites=len(self.group),
+                               active=self.active_count,
+                               pair_checks=self.collision_pair_checks)
+        self.on_cleanup()
+
     def run(self):
+        if self.fixed_step:
+            return self.run_fixed()
+
+        profiler = self.profiler
         while self._running:
+            d_t = self._clock.tick(self.fps)
+            profiler.begin_frame()
             for event in pygame.event.get():
                 self.on_event(event)
-            self.on_loop()
+            profiler.lap('events')
+            self.on_loop(d_t)
+            profiler.lap('on_loop')
+            profiler.add('depth_sort', self.group.sort_time)
             self.on_collide()
+            profiler.lap('on_collide')
+            self.on_step(d_t)
             self.on_draw()
+            profiler.lap('draw')
+            profiler.add('map_draw', self.group.map_draw_time)
+            profiler.end_frame(sprites=len(self.group), active=self.active_count,
+                               pair_checks=self.collision_pair_checks)
         self.on_cleanup()
 
 
@@ -1,7 +1,11 @@
 import pygame
-import pyganim
 
+import audio
+import hud
 import resources
+from animation import AnimationCursor, load_animations
+from depthmixin import DepthTracked
+from scheduler import SleepMixin
 
 import logging
 
@@ -14,34 +18,73 @@ def floor_for_z(z):
 def z_for_floor(floor):
     return floor * 32
 
-class TriggerMixin(object):
+class TriggerMixin(DepthTracked, SleepMixin):
+    # callback slots, subclasses override the ones they handle
+    on_enter = None
+    on_exit = None
+
+    _target = None
+    _target_on_trigger = None
+
+    # the broadphase this is bucketed in, see moved
+    trigger_hash = None
+
     def __init__(self, *args, **kwargs):
         super(TriggerMixin, self).__init__(*args, **kwargs)
 
         self.collisions_last_frame = set()
         self.active_collisions = set()
 
+    @property
+    def target(self):
+        return self._target
+
+    @target.setter
+    def target(self, target):
+        self._target = target
+        # looked up once here rather than every time this triggers
+        self._target_on_trigger = getattr(target, 'on_trigger', None)
+
+    def moved(self):
+        '''Call after changing rect, z or h, so the broadphase buckets this
+        again and the group sorts it again.  Triggers that never call it stay
+        where they were added.'''
+        if self.trigger_hash is not None:
+            self.trigger_hash.moved(self)
+        super(TriggerMixin, self).moved()
+
+    def trigger_target(self):
+        '''Calls on_trigger on the target, if there is one and it has one.'''
+        if self._target_on_trigger is not None:
+            self._target_on_trigger(self)
+
     def update(self, *args, **kwargs):
         super(TriggerMixin, self).update(*args, **kwargs)
 
         # find collisions not in last frame and do on_exit
         exiting = self.active_collisions - self.collisions_last_frame
-        for c in exiting:
-            if hasattr(self, 'on_exit'):
-                self.on_exit(c)
-            self.active_collisions.remove(c)
+        if exiting:
+            on_exit = self.on_exit
+            for c in exiting:
+                if on_exit is not None:
+                    on_exit(c)
+                self.active_collisions.remove(c)
 
         # reset detection for this frame
         self.collisions_last_frame.clear()
 
+    def can_sleep(self):
+        return not (self.active_collisions or self.collisions_last_frame)
+
     def on_collision(self, other):
         if other is self:
             return
+        self.wake()
 
         track = True
         # find new collisions and do on_enter
         # if on_enter returns False then do not track the other
-        if hasattr(self, 'on_enter') and other not in self.active_collisions:
+        if self.on_enter is not None and other not in self.active_collisions:
             track = self.on_enter(other)
 
         if track is None:
@@ -54,6 +97,9 @@ class TriggerMixin(object):
 
 
 class Teleport(TriggerMixin, pygame.sprite.Sprite):
+    # packaged files to decode ahead of time, see level.map_assets
+    preload_images = ("examples/placeholder_player.png",)
+
     @classmethod
     def from_tmx(cls, tmx_object):
         r = pygame.Rect(
@@ -70,7 +116,7 @@ class Teleport(TriggerMixin, pygame.sprite.Sprite):
     def __init__(self, rect):
         super(Teleport, self).__init__()
         self.rect = rect
-        self.image = pygame.image.load("examples/placeholder_player.png")
+        self.image = resources.load_image("examples/placeholder_player.png")
         # self.rect = self.image.get_rect()
         # self.rect.center = self.position
 
@@ -82,7 +128,7 @@ class Teleport(TriggerMixin, pygame.sprite.Sprite):
             other.teleport_to(self.destination)
 
 
-class Player(pygame.sprite.Sprite):
+class Player(DepthTracked, pygame.sprite.Sprite):
     # how many layers are displayed per floor?
     layers_per_floor = 3
     # out of the x layers per floor, which one does this go on?
@@ -90,6 +136,9 @@ class Player(pygame.sprite.Sprite):
 
     _z = 0
 
+    preload_images = ('examples/placeholder_player_ani.png',)
+    preload_sounds = ("assets/step_grass.wav",)
+
     @classmethod
     def from_tmx(self, tmx_object):
         player = Player((tmx_object.x, tmx_object.y))
@@ -107,7 +156,9 @@ class Player(pygame.sprite.Sprite):
         floor = self.floor
         layer = self.layer
 
-        self._z = value
+        if value != self._z:
+            self._z = value
+            self.moved()
 
         if floor != self.floor:
             logger.debug('floor change {0} to {1}, {2} to {3}'.format(floor, self.floor, layer, self.layer))
@@ -151,6 +202,7 @@ class Player(pygame.sprite.Sprite):
         self.layer = 1
         self._z = 0
 
+        self.image = None  # set from the animation by update_animation
         self.build_animations()
         self.update_animation()
 
@@ -166,9 +218,7 @@ class Player(pygame.sprite.Sprite):
 
         self.velocity = (0, 0)
 
-        self._snd_step_concrete = pygame.mixer.Sound(resources.get("assets/step_concrete.wav"))
-        self._snd_step_grass = pygame.mixer.Sound(resources.get("assets/step_grass.wav"))
-        self._snd_step_water = pygame.mixer.Sound(resources.get("assets/step_water.wav"))
+        self.step_sound = "assets/step_grass.wav"
 
     def add_floor_listener(self, listener):
         '''Adds a callable to be called when this object's floor changes.'''
@@ -178,22 +228,23 @@ class Player(pygame.sprite.Sprite):
         '''Removes the given floor listener.'''
         self._floor_listeners.remove(listener)
 
+    # name -> ((sheet index, ms), ...) in placeholder_player_ani.png
+    animation_frames = (
+        ('idle_up', ((0, 100),)),
+        ('idle_down', ((3, 100),)),
+        ('idle_left', ((6, 100),)),
+        ('idle_right', ((9, 100),)),
+
+        ('walk_up', tuple((x, 200) for x in [1, 0, 2, 0])),
+        ('walk_down', tuple((x, 200) for x in [4, 3, 5, 3])),
+        ('walk_left', tuple((x, 200) for x in [7, 6, 8, 6])),
+        ('walk_right', tuple((x, 200) for x in [10, 9, 11, 9])),
+    )
+
     def build_animations(self):
-        images = pyganim.getImagesFromSpriteSheet(
-            resources.get('examples/placeholder_player_ani.png'),
-            rows=4, cols=3, rects=[])
-
-        self.animations = {
-            'idle_up': [(images[0], 100)],
-            'idle_down': [(images[3], 100)],
-            'idle_left': [(images[6], 100)],
-            'idle_right': [(images[9], 100)],
-
-            'walk_up': zip([images[x] for x in [1, 0, 2, 0]], [200] * 4),
-            'walk_down': zip([images[x] for x in [4, 3, 5, 3]], [200] * 4),
-            'walk_left': zip([images[x] for x in [7, 6, 8, 6]], [200] * 4),
-            'walk_right': zip([images[x] for x in [10, 9, 11, 9]], [200] * 4),
-        }
+        # shared by every player, each one only keeps a cursor
+        self.animations = load_animations('examples/placeholder_player_ani.png', 4, 3,
+                                          self.animation_frames)
 
         self.idle_transitions = {
             'walk_up': 'idle_up',
@@ -202,9 +253,8 @@ class Player(pygame.sprite.Sprite):
             'walk_right': 'idle_right',
         }
 
-        for k, v in self.animations.items():
-            self.animations[k] = pyganim.PygAnimation(list(v))
-
+        self.cursor = AnimationCursor()
+        self.rect = None
         self.animate('idle_up')
 
     def animate(self, name):
@@ -212,12 +262,17 @@ class Player(pygame.sprite.Sprite):
             name = self.idle_transitions.get(self.active_anim, 'idle_down')
             #logger.debug('transition from {0} to {1}'.format(self.active_anim, name))
 
-        self.animations[name].play()
+        self.cursor.play(self.animations[name])
         self.active_anim = name
 
     def update_animation(self):
-        self.image = self.animations[self.active_anim].getCurrentFrame()
-        self.rect = self.image.get_rect()
+        if self.cursor.image is not self.image:
+            self.image = self.cursor.image
+            self.redraw()
+        if self.rect is None:
+            self.rect = self.image.get_rect()
+        else:
+            self.rect.size = self.image.get_size()
 
     def reset_inputs(self):
         self.k_left = 0
@@ -245,6 +300,7 @@ class Player(pygame.sprite.Sprite):
 
     def update(self, d_t):
         self._old_position = self.position
+        old_rect = self.rect.copy()
 
         d_t /= 1000.0
         x, y = self.position
@@ -284,8 +340,8 @@ class Player(pygame.sprite.Sprite):
         d_y = self.velocity[1] * min(d_t * self.speed, distance_y)
 
         if d_x != 0 or d_y != 0:
-            if not pygame.mixer.get_busy():
-                self._snd_step_grass.play()
+            # only plays once the last step has finished
+            audio.manager.play(self.step_sound, 'footsteps')
 
         # print('d_x: {0},    d_y: {1}'.format(d_x, d_y))
 
@@ -298,11 +354,14 @@ class Player(pygame.sprite.Sprite):
             if not self.has_input:
                 self.animate('idle')
 
+        self.cursor.update(d_t * 1000.0)
         self.update_animation()
 
         # keep our feet on the ground
         self.rect.topleft = self.position
         self.feet.midbottom = self.rect.midbottom
+        if self.rect != old_rect:
+            self.moved()
 
     # This is used to move back from walls
     # Should really be more generic collision response
@@ -342,17 +401,49 @@ class Player(pygame.sprite.Sprite):
 
         self.rect.topleft = self.position
         self.feet.midbottom = self.rect.midbottom
+        self.moved()
 
     def teleport_to(self, destination):
         # move us to the new spot
         self.rect.clamp_ip(destination)
         self.position = self.rect.topleft
+        self.moved()
 
         # and reset input
         self.reset_inputs()
 
 
+def _stored_property(name):
+    '''An attribute kept in the object's EntityStore while it has one.'''
+    attr = '_' + name
+
+    def fget(self):
+        if self.store is None:
+            return getattr(self, attr)
+        return int(getattr(self.store, name)[self.row])
+
+    def fset(self, value):
+        if self.store is None:
+            setattr(self, attr, value)
+        else:
+            self.store.set(self, name, value)
+    return property(fget, fset)
+
+
 class RisingPlatform(TriggerMixin, pygame.sprite.Sprite):
+    # set while an EntityStore holds z, floor and height and steps the height
+    store = None
+    row = None
+
+    preload_images = ("examples/platformgrass.png",)
+
+    _z = 0
+    _floor = 0
+    _height = 0
+    z = _stored_property('z')
+    floor = _stored_property('floor')
+    height = _stored_property('height')
+
     @classmethod
     def from_tmx(cls, tmx_object):
         platform = RisingPlatform((tmx_object.x, tmx_object.y), int(tmx_object.floor))
@@ -366,7 +457,7 @@ class RisingPlatform(TriggerMixin, pygame.sprite.Sprite):
         self.height = floor * 32
         self.rect = pygame.Rect((position[0] - 8, position[1] - 8), (32, 32))
         self.rect = pygame.Rect((position[0], position[1]), (32, 32))
-        self.image = pygame.image.load(resources.get("examples/platformgrass.png"))
+        self.image = resources.load_image("examples/platformgrass.png")
         self.image_offset = (-8, -8)
 
     @property
@@ -379,17 +470,26 @@ class RisingPlatform(TriggerMixin, pygame.sprite.Sprite):
 
     @property
     def stopped(self):
+        if self.store is not None:
+            return self not in self.store.moving
         return not (self.rising or self.falling)
 
+    def can_sleep(self):
+        return self.stopped and super(RisingPlatform, self).can_sleep()
+
     def update(self, d_t):
         super(RisingPlatform, self).update(d_t)
 
-        if self.falling:
-            self.height -= 1
-        elif self.rising:
-            self.height += 1
+        # with a store every platform's height was stepped already
+        if self.store is None:
+            if self.falling:
+                self.height -= 1
+            elif self.rising:
+                self.height += 1
 
-        self.z = self.height
+            if self.z != self.height:
+                self.z = self.height
+                self.moved()
 
         # anything touching (contained? half contained?) the platform should be moved as well
         for game_object in self.active_collisions:
@@ -430,8 +530,7 @@ class RisingPlatform(TriggerMixin, pygame.sprite.Sprite):
 
         logger.info('{other} entered {self}'.format(other=other, self=self))
 
-        if hasattr(self, 'target') and hasattr(self.target, 'on_trigger'):
-            self.target.on_trigger(self)
+        self.trigger_target()
 
         return True
 
@@ -442,6 +541,7 @@ class RisingPlatform(TriggerMixin, pygame.sprite.Sprite):
             pass
 
     def on_trigger(self, other):
+        self.wake()
         if self.stopped:
             if self.floor == 0:
                 self.floor = 1
@@ -494,6 +594,13 @@ class RisingFallingPlatform(RisingPlatform):
 
 
 class Switch(TriggerMixin, pygame.sprite.Sprite):
+    floor = 0
+
+    _active = False
+
+    preload_images = ("assets/stonepad.png",)
+    preload_sounds = ("assets/step_concrete.wav",)
+
     @classmethod
     def from_tmx(cls, tmx_object):
         rect = pygame.Rect(
@@ -509,30 +616,49 @@ class Switch(TriggerMixin, pygame.sprite.Sprite):
     def __init__(self, rect):
         super(Switch, self).__init__()
         self.rect = rect
-        images = pyganim.getImagesFromSpriteSheet(
-            resources.get("assets/stonepad.png"),
-            rows=1, cols=2, rects=[])
-        self._sound = pygame.mixer.Sound("assets/step_concrete.wav")
+        images = resources.load_sheet("assets/stonepad.png", rows=1, cols=2)
+
+        self._toggle_listeners = set()
 
         self.image = images[0]
         self.released_image = images[0]
         self.pressed_image = images[1]
         self.active = False
 
+    @property
+    def active(self):
+        return self._active
+
+    @active.setter
+    def active(self, value):
+        if value != self._active:
+            self._active = value
+            for listener in self._toggle_listeners:
+                listener(self)
+
+    def add_toggle_listener(self, listener):
+        '''Adds a callable to be called when this switch turns on or off.'''
+        self._toggle_listeners.add(listener)
+
+    def remove_toggle_listener(self, listener):
+        '''Removes the given toggle listener.'''
+        self._toggle_listeners.remove(listener)
+
     def on_enter(self, other):
-        if isinstance(other, Player) and getattr(self, 'floor', 0) == other.floor:
+        if isinstance(other, Player) and self.floor == other.floor:
             if not self.active:
-                self._sound.play()
+                audio.manager.play("assets/step_concrete.wav", 'switches', priority=1)
             self.active = True
             self.image = self.pressed_image
+            self.redraw()
 
-            if hasattr(self, 'target') and hasattr(self.target, 'on_trigger'):
-                self.target.on_trigger(self)
+            self.trigger_target()
 
     def on_exit(self, other):
         if self.active:
             self.active = False
             self.image = self.released_image
+            self.redraw()
 
 
 class Keystone(TriggerMixin, pygame.sprite.Sprite):
@@ -543,6 +669,15 @@ class Keystone(TriggerMixin, pygame.sprite.Sprite):
 
     _z = 0
 
+    # set when the "YOU WON!" text replaces the keystone
+    image_offset = None
+
+    animation_frames = (
+        ('glow', tuple((x, 200) for x in [0, 1, 2, 3, 4, 3, 2, 1])),
+    )
+
+    preload_images = ('examples/keystone.png',)
+
     @classmethod
     def from_tmx(cls, tmx_object):
         rect = pygame.Rect(
@@ -563,7 +698,9 @@ class Keystone(TriggerMixin, pygame.sprite.Sprite):
     def z(self, value):
         floor = self.floor
 
-        self._z = value
+        if value != self._z:
+            self._z = value
+            self.moved()
 
         if floor != self.floor:
             self.on_floor_change()
@@ -589,6 +726,7 @@ class Keystone(TriggerMixin, pygame.sprite.Sprite):
         self.floor = int((value - self.layer_floor_offset) / self.layers_per_floor)
 
     def on_floor_change(self):
+        self.wake()
         for listener in self._floor_listeners:
             listener(self)
 
@@ -597,28 +735,29 @@ class Keystone(TriggerMixin, pygame.sprite.Sprite):
         self._floor_listeners = set()
 
         self.rect = rect
-        self.images = pyganim.getImagesFromSpriteSheet(resources.get('examples/keystone.png'),
-            rows=1, cols=5, rects=[])
-        self.animation = pyganim.PygAnimation(zip([self.images[x] for x in [0, 1, 2, 3, 4, 3, 2, 1]], [200] * 8))
-        self.animate()
-        self.image = self.images[0]
+        animations = load_animations('examples/keystone.png', 1, 5, self.animation_frames)
+        self.cursor = AnimationCursor(animations['glow'])
+        self.image = self.cursor.image
 
         self.won = False
 
-        self.font = pygame.font.SysFont('Courier', 48, True, True)
-
     def animate(self):
-        self.animation.play()
+        self.cursor.play()
 
     def on_enter(self, other):
         if isinstance(other, Player):
             self.won = True
 
-            surf = self.font.render("YOU WON!", False, (200, 50, 50))
+            # rendered now rather than with the level, finding fonts is slow
+            surf = hud.render_text("YOU WON!", ('Courier', 48, True, True), (200, 50, 50))
             self.image = surf
             self.image_offset = (-surf.get_width() / 2, 0)
+            self.redraw()
 
     def update(self, dt):
         super(Keystone, self).update(dt)
         if not self.won:
-            self.image = self.animation.getCurrentFrame()
+            self.cursor.update(dt)
+            if self.image is not self.cursor.image:
+                self.image = self.cursor.image
+                self.redraw()
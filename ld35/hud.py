@@ -0,0 +1,174 @@
+'''Text drawn over the game, without rendering it again every frame.
+
+Rendered strings are cached by text, font and color.  The Hud keeps its lines
+on a surface between frames and only redraws a line when its text changes, by
+blitting glyphs from a glyph atlas, so a counter going up is a few blits rather
+than a font render.'''
+from collections import OrderedDict
+
+import pygame
+
+import resources
+
+# load_font arguments
+DEFAULT_FONT = ('Courier', 14)
+DEFAULT_COLOR = (255, 255, 255)
+
+_strings = resources.ResourceCache(512)
+_atlases = {}  # (font, color, antialias) -> GlyphAtlas
+
+
+def _alpha(surface):
+    # font.render gives a colorkeyed surface unless antialiased
+    if pygame.display.get_surface() is not None:
+        return surface.convert_alpha()
+    image = pygame.Surface(surface.get_size(), pygame.SRCALPHA)
+    image.fill((0, 0, 0, 0))
+    image.blit(surface, (0, 0))
+    return image
+
+
+class GlyphAtlas(object):
+    '''Every character rendered so far in one font and color, side by side on
+    one surface.
+
+    Strings are put together glyph by glyph without kerning, which matches
+    font.render for monospaced fonts like the default Courier.'''
+    def __init__(self, font, color, antialias=False):
+        self.font = font
+        self.color = color
+        self.antialias = antialias
+        self.surface = pygame.Surface((0, font.get_height()), pygame.SRCALPHA)
+        self._glyphs = {}  # character -> (area on surface, advance)
+
+    def __len__(self):
+        return len(self._glyphs)
+
+    def glyph(self, char):
+        try:
+            return self._glyphs[char]
+        except KeyError:
+            pass
+
+        image = _alpha(self.font.render(char, self.antialias, self.color))
+        w, h = image.get_size()
+        old = self.surface
+        x = old.get_width()
+        self.surface = pygame.Surface((x + w, max(h, old.get_height())), pygame.SRCALPHA)
+        self.surface.fill((0, 0, 0, 0))
+        self.surface.blit(old, (0, 0))
+        self.surface.blit(image, (x, 0))
+
+        metrics = self.font.metrics(char)[0]
+        advance = metrics[4] if metrics is not None else w
+        glyph = self._glyphs[char] = (pygame.Rect(x, 0, w, h), advance)
+        return glyph
+
+    def size(self, text):
+        x = 0
+        width = 0
+        for area, advance in [self.glyph(c) for c in text]:
+            width = max(width, x + area.width)
+            x += advance
+        return width, self.font.get_height()
+
+    def draw(self, surface, pos, text):
+        '''Draws text onto a transparent part of surface, with pos at its top
+        left.'''
+        atlas = self.surface
+        blit = surface.blit
+        x, y = pos
+        for area, advance in [self.glyph(c) for c in text]:
+            # max copies the glyph onto the cleared pixels, and keeps the
+            # inked pixels of both where glyphs overlap a little
+            blit(atlas, (x, y), area, pygame.BLEND_RGBA_MAX)
+            x += advance
+
+
+def discard_fonts():
+    '''Drops the glyph atlases, whose fonts pygame.quit leaves unusable.'''
+    _atlases.clear()
+
+
+def glyph_atlas(font=DEFAULT_FONT, color=DEFAULT_COLOR, antialias=False):
+    '''The shared GlyphAtlas for font, given as load_font arguments.'''
+    key = (tuple(font), tuple(color), antialias)
+    try:
+        return _atlases[key]
+    except KeyError:
+        atlas = _atlases[key] = GlyphAtlas(resources.load_font(*font), color, antialias)
+        return atlas
+
+
+def render_text(text, font=DEFAULT_FONT, color=DEFAULT_COLOR, antialias=False):
+    '''Returns text rendered in font (load_font arguments) and color, cached.
+    The surface is shared, so do not draw on it.'''
+    font = tuple(font)
+    color = tuple(color)
+
+    def loader():
+        return _alpha(resources.load_font(*font).render(text, antialias, color))
+    return _strings.get(('text', text, font, color, antialias), loader)
+
+
+class Hud(object):
+    '''Lines of text in a column in the top right corner of the screen.
+
+    set_text only redraws a line's part of the HUD surface when its text has
+    changed, and draw blits the part in use onto the screen in one go.
+    dirty lists the screen rects that changed since the last draw, for
+    callers that only update part of the screen.'''
+    def __init__(self, size, font=DEFAULT_FONT, color=DEFAULT_COLOR, margin=8):
+        self.surface = pygame.Surface(size, pygame.SRCALPHA)
+        self.surface.fill((0, 0, 0, 0))
+        self.font = tuple(font)
+        self.color = tuple(color)
+        self.margin = margin
+        self.atlas = None  # finding the font is slow, see set_text
+        self.dirty = []
+        self._visible = True
+        self._lines = OrderedDict()  # name -> [text, rect on surface]
+        self._area = None  # union of the line rects
+
+    @property
+    def visible(self):
+        return self._visible
+
+    @visible.setter
+    def visible(self, value):
+        if value != self._visible:
+            self._visible = value
+            if self._area is not None:
+                self.dirty.append(self._area.copy())
+
+    def set_text(self, name, text):
+        '''Shows text on the line called name, adding the line below the
+        others if it is new.'''
+        line = self._lines.get(name)
+        if line is None:
+            line = self._lines[name] = [None, None]
+        elif line[0] == text:
+            return
+        line[0] = text
+        if self.atlas is None:
+            self.atlas = glyph_atlas(self.font, self.color)
+        atlas = self.atlas
+
+        old = line[1]
+        width, height = atlas.size(text)
+        top = self.margin + height * list(self._lines).index(name)
+        line[1] = pygame.Rect(self.surface.get_width() - self.margin - width, top, width, height)
+
+        changed = line[1] if old is None else old.union(line[1])
+        self.surface.fill((0, 0, 0, 0), changed)
+        atlas.draw(self.surface, line[1].topleft, text)
+        self.dirty.append(changed)
+        # lines are right aligned and one line high, so none overlap; only the
+        # width of the area can change
+        rects = [r for _, r in self._lines.values()]
+        self._area = rects[0].unionall(rects[1:])
+
+    def draw(self, surface):
+        if self._visible and self._area is not None:
+            surface.blit(self.surface, self._area.topleft, self._area)
+        self.dirty = []
@@ -0,0 +1,341 @@
+import sys
+import threading
+
+import pygame
+from pytmx.util_pygame import load_pygame
+import pyscroll
+import six
+
+from depthmixin import DepthOrderedScrollGroup as PyscrollGroup
+
+import audio
+import entitystore
+import gameobjects
+import mapcache
+import resources
+import scaling
+from collision import build_collision_grids, build_region_collision
+from scheduler import Scheduler
+from spatial import SpatialHash
+
+import logging
+logger = logging.getLogger()
+
+
+def map_assets(filename, data=None):
+    '''Returns the image and sound files (absolute paths) loading filename as a
+    Level will need: its tilesets when the map cache is used, and what its
+    object types and the audio manager preload.  data is the map's
+    mapcache.load_data, or None when the map cache is not used.'''
+    if data is not None:
+        images = set(mapcache.tileset_files(filename, data))
+        types = set(o[2] for o in data['objects'])
+    else:
+        # pytmx loads the tilesets itself, and finding the object types would
+        # mean parsing the map twice, so take every type's files
+        images = set()
+        types = dir(gameobjects)
+
+    sounds = set(audio.manager.preload)
+    for name in types:
+        klass = getattr(gameobjects, name, None)
+        images.update(resources.get(f) for f in getattr(klass, 'preload_images', ()))
+        sounds.update(getattr(klass, 'preload_sounds', ()))
+    return sorted(images), sorted(resources.get(f) for f in sounds)
+
+
+class Level(object):
+    '''Everything loaded from one map: the renderer, sprites, walls and
+    triggers.  Building one does not touch the running game, so it can be done
+    on another thread and handed to Game.set_level when it is ready.
+
+    With streaming, the map is split into square regions of region_size
+    pixels and only objects and walls in regions within radius regions of the
+    point passed to stream() are in the group, triggers and collision grids.
+    The collision grids are built per region when the level loads, so
+    streaming only changes which of them are queried.  Objects are made the first time their region (or a trigger that targets
+    them) needs them, and keep their state while their region is unloaded.
+
+    With scheduling, objects far from the player that have stopped doing
+    anything are not updated, see Scheduler.
+
+    With entity_store (needs NumPy), platforms keep their height, z and floor
+    in an EntityStore, which steps them all at once and culls them for drawing.
+
+    With prescaled, tiles and sprite images are scaled up to the zoom once and
+    drawn at 1:1 by a ScaledRenderer, rather than drawn small and the view
+    scaled every frame.'''
+    zoom = 4
+
+    def __init__(self, filename, view_size, use_map_cache=True,
+                 streaming=False, region_size=512, radius=1, scheduling=True,
+                 entity_store=False, prescaled=True, cache_data=None):
+        self.filename = filename
+        self.streaming = streaming
+        self.region_size = region_size
+        self.radius = radius
+
+        # Load map data
+        if use_map_cache:
+            # cache_data saves reading and hashing the file again
+            tmx_data = mapcache.load(filename, cache_data)
+        else:
+            tmx_data = load_pygame(filename)
+        self.tmx_data = tmx_data
+        self.music = tmx_data.properties.get('music')
+
+        map_data = pyscroll.data.TiledMapData(tmx_data)
+        if prescaled:
+            self.map_layer = scaling.ScaledRenderer(map_data, view_size, zoom=self.zoom)
+        else:
+            self.map_layer = pyscroll.BufferedRenderer(map_data, view_size)
+            self.map_layer.zoom = self.zoom
+        self.store = None
+        if entity_store:
+            if entitystore.available:
+                self.store = entitystore.EntityStore()
+            else:
+                logger.warning('NumPy is not installed, not using an entity store')
+
+        self.scheduler = Scheduler() if scheduling else None
+        self.group = PyscrollGroup(map_layer=self.map_layer, default_layer=2,
+                                   scheduler=self.scheduler, store=self.store)
+
+        # setup level geometry with simple pygame rects, loaded from pytmx
+        self.walls = {} # key is floor, value is list of wall rects
+        self.collision = {}
+
+        self.player = None
+        self.pushable = []  # sprites walls push back, see Game.on_loop
+        self.trigger_targets = {}  # targets by target ID
+        self.waiting_triggers = {} # lists of trigger targets by target ID
+        self.triggers = []
+        self.trigger_hash = SpatialHash()  # broadphase for trigger rects
+        self.trigger_order = {}  # trigger -> load order, kept while unloaded
+        self.switches = []  # every Switch made so far, for the HUD
+        self.active_switches = 0  # how many of them are on, see switch_toggled
+
+        # only used when streaming
+        self.active_regions = set()
+        self._region_objects = {}  # region -> IDs of map objects touching it
+        self._region_walls = {}    # region -> [(floor, (x, y, w, h))]
+        self._tmx_objects = {}     # ID -> map object not made yet
+        self._objects = {}         # ID -> game object made from the map
+        self._active = set()       # IDs of objects in the group
+
+        # Find known object types and attach behavior
+        for o in tmx_data.objects:
+            if hasattr(gameobjects, o.type):
+                klass = getattr(gameobjects, o.type)
+                if hasattr(klass, 'from_tmx'):
+                    if streaming and o.name != 'Player':
+                        self._tmx_objects[int(o.id)] = o
+                        for region in self._regions_for(o.x, o.y, o.width, o.height):
+                            self._region_objects.setdefault(region, []).append(int(o.id))
+                        continue
+
+                    game_object = self._make_object(o)
+                    self._activate(game_object)
+
+            elif o.type == 'Wall':
+                floor = int(o.properties.get('floor', 0))
+                self._add_wall(floor, (o.x, o.y, o.width, o.height))
+            else:
+                logger.error('Unrecognized object type: {0}'.format(o.type))
+
+        # the map cache keeps walls in a table rather than as objects
+        for floor, rects in getattr(tmx_data, 'walls', {}).items():
+            for rect in rects:
+                self._add_wall(floor, rect)
+
+        if streaming:
+            # split by region once here, so stream only picks which to use
+            self.collision.update(build_region_collision(tmx_data, self._region_walls,
+                                                         region_size))
+            self.stream(self.player.rect.center)
+        else:
+            # walls and the Collision tile layer merged into a grid per floor
+            self.collision.update(build_collision_grids(tmx_data, self.walls))
+
+        self.group.center(self.player.rect.center)
+
+    def _regions_for(self, x, y, width, height):
+        size = self.region_size
+        left, top = int(x) // size, int(y) // size
+        right = int(x + max(width, 1) - 1) // size
+        bottom = int(y + max(height, 1) - 1) // size
+        return [(c, r) for c in range(left, right + 1) for r in range(top, bottom + 1)]
+
+    def _add_wall(self, floor, rect):
+        if self.streaming:
+            for region in self._regions_for(*rect):
+                self._region_walls.setdefault(region, []).append((floor, tuple(rect)))
+        else:
+            self.walls.setdefault(floor, []).append(pygame.Rect(rect))
+
+    def _make_object(self, o):
+        klass = getattr(gameobjects, o.type)
+        game_object = klass.from_tmx(o)
+        game_object.id = int(o.id)
+        game_object.z = 0
+        game_object.h = 0
+        floor = int(o.properties.get('floor', 0))
+        game_object.floor = floor
+        if hasattr(o, 'target_id'):
+            game_object.target_id = getattr(o, 'target_id')
+
+        if o.name == 'Player':
+            self.player = game_object
+            self.player.h = 16
+            self.player.add_floor_listener(self.sprite_layer_handler)
+            if self.scheduler is not None:
+                self.scheduler.focus = self.player
+
+        self._objects[game_object.id] = game_object
+        self.save_trigger_target(game_object)
+        return game_object
+
+    def get_object(self, object_id):
+        '''Returns the game object made from map object ID object_id, making it
+        if its region has not been loaded yet.  None if there is no such object.'''
+        game_object = self._objects.get(object_id)
+        if game_object is None and object_id in self._tmx_objects:
+            game_object = self._make_object(self._tmx_objects.pop(object_id))
+        return game_object
+
+    def _activate(self, game_object):
+        self._active.add(game_object.id)
+        if self.store is not None and isinstance(game_object, gameobjects.RisingPlatform):
+            self.store.add(game_object)
+        self.group.add(game_object)
+        if hasattr(game_object, 'move_back'):
+            self.pushable.append(game_object)
+        if isinstance(game_object, gameobjects.TriggerMixin):
+            self.add_trigger(game_object)
+
+    def _deactivate(self, game_object):
+        self._active.discard(game_object.id)
+        self.group.remove(game_object)
+        if game_object in self.pushable:
+            self.pushable.remove(game_object)
+        if self.store is not None and game_object in self.store:
+            self.store.remove(game_object)
+        if game_object in self.trigger_hash:
+            self.triggers.remove(game_object)
+            self.trigger_hash.remove(game_object)
+
+    def stream(self, center):
+        '''Loads the regions around center and unloads the rest.'''
+        if not self.streaming:
+            return
+
+        column, row = int(center[0]) // self.region_size, int(center[1]) // self.region_size
+        radius = self.radius
+        regions = set((c, r) for c in range(column - radius, column + radius + 1)
+                      for r in range(row - radius, row + radius + 1))
+        if regions == self.active_regions:
+            return
+        self.active_regions = regions
+
+        wanted = set()
+        walls = set()
+        for region in regions:
+            wanted.update(self._region_objects.get(region, ()))
+            walls.update(self._region_walls.get(region, ()))
+
+        for object_id in self._active - wanted:
+            game_object = self._objects[object_id]
+            if game_object is not self.player:
+                self._deactivate(game_object)
+        for object_id in sorted(wanted - self._active):
+            self._activate(self.get_object(object_id))
+
+        # rebuilt in place, the game holds on to these
+        self.walls.clear()
+        for floor, rect in sorted(walls):
+            self.walls.setdefault(floor, []).append(pygame.Rect(rect))
+        for region_walls in self.collision.values():
+            region_walls.loaded = regions
+
+    def sprite_layer_handler(self, sender):
+        logger.debug('change sprite {0} to layer: {1}'.format(sender, sender.layer))
+        self.group.change_layer(sender, sender.layer)
+
+    def switch_toggled(self, switch):
+        self.active_switches += 1 if switch.active else -1
+
+    def save_trigger_target(self, target):
+        # Track all objects as possible trigger targets
+        self.trigger_targets[target.id] = target
+
+        # Complete any triggers waiting for this target
+        logger.debug('waiting triggers: {0}'.format(self.waiting_triggers))
+        if target.id in self.waiting_triggers:
+            for trigger in self.waiting_triggers[target.id]:
+                trigger.target = target
+                logger.debug('Completing trigger {0} with target: {1}/{2}'.format(trigger.id, target.id, target))
+        else:
+            logger.debug('Failed to find triggers for target: {0}, {1}'.format(target.id, target))
+
+    def add_trigger(self, game_object):
+        self.triggers.append(game_object)
+        self.trigger_hash.add(game_object)
+        game_object.trigger_hash = self.trigger_hash
+        if game_object in self.trigger_order:
+            # streamed back in, already hooked up
+            return
+        self.trigger_order[game_object] = len(self.trigger_order)
+        if isinstance(game_object, gameobjects.Switch):
+            self.switches.append(game_object)
+            if game_object.active:
+                self.active_switches += 1
+            game_object.add_toggle_listener(self.switch_toggled)
+
+        if hasattr(game_object, 'target_id') and game_object.target_id is not None:
+            target_id = game_object.target_id
+            if target_id == 'self':
+                target_id = int(game_object.id)
+            else:
+                target_id = int(target_id)
+
+            # hook it up if we can, making the target if it is in an unloaded region
+            game_object.target = self.get_object(target_id)
+            logger.debug('Adding trigger {0} with target: {1}/{2}'.format(game_object.id,
+                                                                            target_id,
+                                                                            game_object.target))
+
+            # store it for later if not
+            t = self.waiting_triggers.get(target_id, [])
+            t.append(game_object)
+            self.waiting_triggers[target_id] = t
+
+
+class LevelLoader(threading.Thread):
+    '''Builds a Level on a worker thread.  Poll done, then call result() on the
+    main thread; it raises whatever the load raised.'''
+    def __init__(self, filename, view_size, **kwargs):
+        super(LevelLoader, self).__init__(name='LevelLoader({0})'.format(filename))
+        self.daemon = True
+        self.filename = filename
+        self.view_size = view_size
+        self.kwargs = kwargs  # passed on to Level
+        self.swap = False  # set when the game should switch to it once loaded
+
+        self._level = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._level = Level(self.filename, self.view_size, **self.kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    @property
+    def done(self):
+        return self.ident is not None and not self.is_alive()
+
+    def result(self):
+        self.join()
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        return self._level
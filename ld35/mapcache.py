@@ -0,0 +1,296 @@
+'''Compiles TMX maps into a compact binary cache so they load without parsing
+XML or decoding layer data.
+
+The cache file is named after a hash of the TMX file's contents, so editing a
+map simply misses the cache and compiles it again.  Loading gives a CachedMap,
+which has the parts of pytmx.TiledMap that the game and pyscroll use.
+
+To compile maps ahead of time:
+
+    python -m ld35.mapcache map.tmx [map.tmx ...]
+'''
+from array import array
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import tempfile
+
+import pygame
+import pytmx
+from pytmx.util_pygame import handle_transformation, smart_convert
+
+import resources
+
+logger = logging.getLogger()
+
+# bump when the layout of the cache changes
+CACHE_VERSION = 2
+
+
+def cache_dir():
+    return os.environ.get('LD35_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'ld35'))
+
+
+def source_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cache_filename(filename):
+    return os.path.join(cache_dir(), '{0}-{1}.map'.format(source_hash(filename),
+                                                         CACHE_VERSION))
+
+
+def _pack(values):
+    a = array('I', values)
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _unpack(data):
+    a = array('I')
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    return a
+
+
+def _recording_loader(tmx_dir):
+    '''An image loader for pytmx that records where each tile comes from
+    instead of loading anything.'''
+    def loader(filename, colorkey, **kwargs):
+        path = os.path.relpath(filename, tmx_dir)
+
+        def load(rect=None, flags=None):
+            return (path, colorkey, rect and tuple(rect), flags and tuple(flags))
+        return load
+    return loader
+
+
+def _image_loader(filename, colorkey, pixelalpha=True):
+    '''pytmx.util_pygame.pygame_image_loader, taking the tileset from
+    resources.preload if it was preloaded.'''
+    if colorkey:
+        colorkey = pygame.Color('#{0}'.format(colorkey))
+    image = resources.decode_image(filename)
+
+    def load(rect=None, flags=None):
+        tile = image.subsurface(rect) if rect else image.copy()
+        if flags:
+            tile = handle_transformation(tile, flags)
+        return smart_convert(tile, colorkey, pixelalpha)
+    return load
+
+
+def tileset_files(filename, data):
+    '''Returns the absolute paths of the images data (from read_cache or
+    compile_map) uses for tiles.'''
+    tmx_dir = os.path.dirname(os.path.abspath(filename))
+    paths = set(tile[0] for tile in data['tiles'] if tile is not None)
+    return sorted(os.path.join(tmx_dir, path) for path in paths)
+
+
+def compile_map(filename):
+    '''Parses a TMX file into a dict of plain values for the cache.'''
+    tmx_dir = os.path.dirname(os.path.abspath(filename))
+    tmx = pytmx.TiledMap(filename, image_loader=_recording_loader(tmx_dir))
+
+    layers = []
+    for layer in tmx.layers:
+        if isinstance(layer, pytmx.TiledTileLayer):
+            gids = _pack(gid for row in layer.data for gid in row)
+            layers.append(('tiles', layer.name, bool(layer.visible),
+                           dict(layer.properties), gids))
+        else:
+            layers.append(('other', layer.name, bool(layer.visible),
+                           dict(layer.properties), None))
+
+    objects = []
+    walls = {}
+    for o in tmx.objects:
+        properties = dict(o.properties)
+        if o.type == 'Wall':
+            floor = int(properties.get('floor', 0))
+            walls.setdefault(floor, []).append((int(o.x), int(o.y),
+                                                int(o.width), int(o.height)))
+            continue
+        objects.append((int(o.id), o.name, o.type, o.x, o.y, o.width, o.height,
+                        properties))
+
+    animations = []
+    for gid, props in tmx.tile_properties.items():
+        frames = props.get('frames')
+        if frames:
+            animations.append((gid, [tuple(frame) for frame in frames]))
+
+    return {
+        'version': CACHE_VERSION,
+        'size': (tmx.width, tmx.height),
+        'tile_size': (tmx.tilewidth, tmx.tileheight),
+        'properties': dict(tmx.properties),
+        'tiles': [image for image in tmx.images],
+        'animations': animations,
+        'layers': layers,
+        'objects': objects,
+        'walls': walls,
+    }
+
+
+def write_cache(filename, data, path=None):
+    if path is None:
+        path = cache_filename(filename)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # write somewhere else first so a crash never leaves half a cache
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(data, f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write map cache {0}: {1}'.format(path, e))
+    return path
+
+
+def read_cache(filename, path=None):
+    '''Returns the cached data for filename, or None if it is not cached.
+    path is where it is cached, if already known.'''
+    if path is None:
+        path = cache_filename(filename)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError) as e:
+        logger.warning('Ignoring unreadable map cache {0}: {1}'.format(path, e))
+        return None
+    if data.get('version') != CACHE_VERSION:
+        return None
+    return data
+
+
+def load_data(filename):
+    '''Returns the cached data for filename, compiling and caching it first if
+    needed.  Does not load any images.'''
+    path = cache_filename(filename)
+    data = read_cache(filename, path)
+    if data is None:
+        data = compile_map(filename)
+        write_cache(filename, data, path)
+    return data
+
+
+def load(filename, data=None):
+    '''Loads filename from the cache, compiling and caching it first if
+    needed.  Needs a display mode set for the tile images.  Pass data if it
+    was already read with load_data.'''
+    if data is None:
+        data = load_data(filename)
+    return CachedMap(filename, data)
+
+
+class CachedTileLayer(object):
+    def __init__(self, name, visible, properties, data):
+        self.name = name
+        self.visible = visible
+        self.properties = properties
+        self.data = data  # rows of gids, like pytmx
+
+
+class CachedLayer(object):
+    def __init__(self, name, visible, properties):
+        self.name = name
+        self.visible = visible
+        self.properties = properties
+
+
+class CachedObject(object):
+    '''A map object.  Properties are also attributes, like in pytmx.'''
+    def __init__(self, id, name, type, x, y, width, height, properties):
+        self.__dict__.update(properties)
+        self.id = id
+        self.name = name
+        self.type = type
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.properties = properties
+
+
+class CachedMap(object):
+    '''The parts of pytmx.TiledMap used by the game and pyscroll, loaded from
+    the map cache.  Wall objects are not in objects, they are in walls.'''
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.width, self.height = data['size']
+        self.tilewidth, self.tileheight = data['tile_size']
+        self.properties = data['properties']
+        self.walls = data['walls']  # floor -> [(x, y, w, h)]
+
+        self.layers = []
+        for kind, name, visible, properties, gids in data['layers']:
+            if kind == 'tiles':
+                gids = _unpack(gids)
+                w = self.width
+                rows = [gids[i:i + w].tolist() for i in range(0, len(gids), w)]
+                self.layers.append(CachedTileLayer(name, visible, properties, rows))
+            else:
+                self.layers.append(CachedLayer(name, visible, properties))
+
+        self.objects = [CachedObject(*o) for o in data['objects']]
+
+        self.tile_properties = dict((gid, {'frames': frames})
+                                    for gid, frames in data['animations'])
+        self.images = self._load_images(data['tiles'])
+
+    def _load_images(self, tiles):
+        tmx_dir = os.path.dirname(os.path.abspath(self.filename))
+        loaders = {}
+        images = []
+        for tile in tiles:
+            if tile is None:
+                images.append(None)
+                continue
+            path, colorkey, rect, flags = tile
+            key = path, colorkey
+            if key not in loaders:
+                loaders[key] = _image_loader(os.path.join(tmx_dir, path), colorkey)
+            images.append(loaders[key](rect and pygame.Rect(rect),
+                                       flags and pytmx.TileFlags(*flags)))
+        return images
+
+    @property
+    def visible_layers(self):
+        return (layer for layer in self.layers if layer.visible)
+
+    @property
+    def visible_tile_layers(self):
+        return (i for i, layer in enumerate(self.layers)
+                if layer.visible and isinstance(layer, CachedTileLayer))
+
+    def get_tile_image(self, x, y, layer):
+        if x < 0 or y < 0:
+            raise ValueError
+        try:
+            gid = self.layers[layer].data[y][x]
+        except (IndexError, AttributeError):
+            raise ValueError
+        return self.get_tile_image_by_gid(gid)
+
+    def get_tile_image_by_gid(self, gid):
+        try:
+            return self.images[gid]
+        except IndexError:
+            raise ValueError
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    for filename in sys.argv[1:]:
+        path = write_cache(filename, compile_map(filename))
+        print('{0} -> {1}'.format(filename, path))
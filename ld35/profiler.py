@@ -0,0 +1,119 @@
+from collections import deque
+import csv
+from timeit import default_timer
+
+import pygame
+
+import resources
+
+
+class FrameProfiler(object):
+    '''Records how long each phase of a frame took, plus a few counters, for
+    the last `size` frames.
+
+    Call begin_frame at the top of the frame, lap after each phase with the
+    phase name, and end_frame with any counters to keep.'''
+    phases = ('events', 'on_loop', 'depth_sort', 'on_collide', 'map_draw', 'draw')
+    text_interval = 0.25  # seconds between redraws of the breakdown text
+
+    def __init__(self, size=300):
+        self.frames = deque(maxlen=size)
+        self.visible = False
+        self._current = None
+        self._last = None
+        self._panel = None
+        self._text = None  # the breakdown, rendered at _text_time
+        self._text_time = None
+
+    def begin_frame(self):
+        self._current = {}
+        self._last = default_timer()
+
+    def lap(self, phase):
+        now = default_timer()
+        self._current[phase] = self._current.get(phase, 0.0) + (now - self._last) * 1000.0
+        self._last = now
+
+    def add(self, phase, ms):
+        '''Records time measured elsewhere, e.g. a part of another phase.'''
+        self._current[phase] = self._current.get(phase, 0.0) + ms
+
+    def end_frame(self, **counters):
+        frame = self._current
+        frame['total'] = sum(frame.get(p, 0.0) for p in self.phases
+                             if p not in ('depth_sort', 'map_draw'))
+        frame.update(counters)
+        self.frames.append(frame)
+        self._current = None
+
+    def dump_csv(self, filename):
+        counters = sorted(set(k for f in self.frames for k in f) -
+                          set(self.phases) - set(['total']))
+        columns = ['total'] + list(self.phases) + counters
+        with open(filename, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for frame in self.frames:
+                writer.writerow([frame.get(c, 0) for c in columns])
+
+    def draw(self, surface, graph_ms=50.0):
+        '''Draws a frame time graph and the last frame's breakdown.  The
+        breakdown is rendered again only every text_interval seconds.'''
+        if not self.frames:
+            return
+
+        height = 100
+        x0, y0 = 8, 8
+        if self._panel is None:
+            self._panel = pygame.Surface((self.frames.maxlen, height))
+            self._panel.set_alpha(180)
+            self._panel.fill((0, 0, 0))
+        surface.blit(self._panel, (x0, y0))
+
+        # one bar per frame, green under 60 fps, red over
+        for i, frame in enumerate(self.frames):
+            ms = frame['total']
+            bar = min(height, int(ms / graph_ms * height))
+            color = (80, 200, 80) if ms <= 1000.0 / 60 else (220, 60, 60)
+            pygame.draw.line(surface, color, (x0 + i, y0 + height),
+                             (x0 + i, y0 + height - bar))
+
+        now = default_timer()
+        if self._text is None or now - self._text_time >= self.text_interval:
+            self._text = self._render_text(self.frames[-1])
+            self._text_time = now
+        surface.blit(self._text, (x0, y0 + height + 4))
+
+    def _render_text(self, frame):
+        font = resources.load_font('Courier', 14)
+        lines = ['{0:>10} {1:6.2f} ms'.format(p, frame.get(p, 0.0))
+                 for p in ('total',) + self.phases]
+        lines += ['{0:>10} {1}'.format(k, v) for k, v in sorted(frame.items())
+                  if k not in self.phases and k != 'total']
+        rendered = [font.render(line, False, (255, 255, 255), (0, 0, 0)) for line in lines]
+        text = pygame.Surface((max(r.get_width() for r in rendered),
+                               sum(r.get_height() for r in rendered)))
+        text.fill((0, 0, 0))
+        y = 0
+        for r in rendered:
+            text.blit(r, (0, y))
+            y += r.get_height()
+        return text
+
+
+class StartupProfiler(object):
+    '''Records how long each stage of starting up took.  Call lap with the
+    stage name at the end of each stage.'''
+    def __init__(self, start=None):
+        self.stages = []  # [(name, ms)]
+        self._last = default_timer() if start is None else start
+
+    def lap(self, stage):
+        now = default_timer()
+        self.stages.append((stage, (now - self._last) * 1000.0))
+        self._last = now
+
+    def report(self):
+        lines = ['{0:>10} {1:8.1f} ms'.format(name, ms) for name, ms in self.stages]
+        lines.append('{0:>10} {1:8.1f} ms'.format('total', sum(ms for _, ms in self.stages)))
+        return '\n'.join(lines)
@@ -0,0 +1,142 @@
+'''Records the input of a play session and replays it without a window.
+
+A log has the map file, then for every simulation step the d_t it ran with,
+the key presses and releases handled before it and a hash of the game state
+after it.  Replaying feeds the same keys and d_t to a headless Game as fast as
+it will go and checks the hash every step, so a log can be used to time the
+same gameplay on two versions of the code:
+
+    python scripts/ld35game.py --record session.ld35r
+    python -m ld35.replay session.ld35r
+
+Changing levels loads on a thread, so sessions that do are not reproducible.
+'''
+import argparse
+import gzip
+import json
+import struct
+import sys
+import time
+import zlib
+
+import pygame
+
+MAGIC = b'LD35R'
+VERSION = 1
+
+_HEADER = struct.Struct('<5sHH')  # magic, version, length of the map filename
+_STEP = struct.Struct('<dBI')     # d_t, number of key events, state hash
+_KEY = struct.Struct('<BH')       # 1 for down or 0 for up, key
+_STATE = struct.Struct('<iiii')
+
+
+def state_hash(game):
+    '''A CRC of the player's position, z and floor and each trigger's state.'''
+    player = game.player
+    x, y = player.position
+    data = [_STATE.pack(int(x), int(y), int(player.z), player.floor)]
+    for trigger in sorted(game.triggers, key=lambda t: t.id):
+        data.append(_STATE.pack(trigger.id, int(getattr(trigger, 'active', 0)),
+                                int(getattr(trigger, 'height', 0)), int(trigger.z)))
+    return zlib.crc32(b''.join(data)) & 0xffffffff
+
+
+class Recorder(object):
+    '''Writes a log; Game calls event for each event and step after each
+    simulation step.'''
+    def __init__(self, filename, map_filename):
+        self._file = gzip.open(filename, 'wb')
+        name = map_filename.encode('utf-8')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, len(name)))
+        self._file.write(name)
+        self._keys = []
+
+    def event(self, event):
+        if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+            self._keys.append((int(event.type == pygame.KEYDOWN), event.key))
+
+    def step(self, d_t, game):
+        keys = self._keys[:255]
+        del self._keys[:255]
+        self._file.write(_STEP.pack(d_t, len(keys), state_hash(game)))
+        for down, key in keys:
+            self._file.write(_KEY.pack(down, key))
+
+    def close(self):
+        self._file.close()
+
+
+def read_log(filename):
+    '''Returns the map filename and a list of (d_t, keys, state hash) steps.'''
+    with gzip.open(filename, 'rb') as f:
+        data = f.read()
+
+    magic, version, length = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('{0} is not a version {1} replay log'.format(filename, VERSION))
+    offset = _HEADER.size
+    map_filename = data[offset:offset + length].decode('utf-8')
+    offset += length
+
+    steps = []
+    while offset < len(data):
+        d_t, count, expected = _STEP.unpack_from(data, offset)
+        offset += _STEP.size
+        keys = []
+        for _ in range(count):
+            keys.append(_KEY.unpack_from(data, offset))
+            offset += _KEY.size
+        steps.append((d_t, keys, expected))
+    return map_filename, steps
+
+
+def replay(filename, check=True, draw=False, **game_options):
+    '''Replays a log in a headless Game.  Returns a dict with the steps run,
+    how long they took and the first step whose state hash did not match, if
+    any.  With draw, every step is also drawn.'''
+    from game import Game
+
+    map_filename, steps = read_log(filename)
+    game = Game(map_filename, headless=True, **game_options)
+
+    mismatch = None
+    start = time.time()
+    for i, (d_t, keys, expected) in enumerate(steps):
+        for down, key in keys:
+            game.on_event(pygame.event.Event(pygame.KEYDOWN if down else pygame.KEYUP, key=key))
+        game.on_loop(d_t)
+        game.on_collide()
+        if draw:
+            game.on_draw()
+        if check and state_hash(game) != expected:
+            mismatch = i
+            break
+    elapsed = time.time() - start
+
+    run = i + 1 if steps else 0
+    return {
+        'map': map_filename,
+        'steps': run,
+        'seconds': elapsed,
+        'steps_per_second': run / elapsed if elapsed > 0 else None,
+        'mismatch': mismatch,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replays a recorded session headlessly.')
+    parser.add_argument('log')
+    parser.add_argument('--no-check', action='store_true',
+                        help='do not compare state hashes, just time the replay')
+    parser.add_argument('--draw', action='store_true', help='draw every step too')
+    args = parser.parse_args(argv)
+
+    result = replay(args.log, check=not args.no_check, draw=args.draw)
+    pygame.quit()
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 1 if result['mismatch'] is not None else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
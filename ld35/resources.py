@@ -1,4 +1,217 @@
-from pkg_resources import resource_filename
+from collections import OrderedDict
+import io
+import os
+import threading
+
+import pygame
+from six.moves import queue
+
+# the package is installed unzipped (zip_safe=False), so its files are next to
+# this one; pkg_resources would find the same paths but takes long to import
+_package_dir = os.path.dirname(os.path.abspath(__file__))
+
 
 def get(filename):
-    return resource_filename('ld35', filename)
+    return os.path.join(_package_dir, filename)
+
+
+class ResourceCache(object):
+    '''A least recently used cache of loaded assets, keyed by path and the
+    parameters they were loaded with.  Safe to use from a loading thread.'''
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, loader):
+        '''Returns the cached value for key, calling loader() to make it if it
+        is not cached yet.'''
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                # move to the most recently used end
+                self._entries[key] = value
+                return value
+
+        # load without the lock, so one thread loading does not block the other
+        value = loader()
+
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, kind):
+        '''Drops the entries whose key starts with kind, e.g. 'font'.'''
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == kind]:
+                del self._entries[key]
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+cache = ResourceCache()
+
+
+class _Preload(object):
+    '''A file being read on a preload thread.'''
+    def __init__(self, path, read):
+        self.path = path
+        self.read = read
+        self.value = None
+        self.done = threading.Event()
+
+
+_preloads = {}  # absolute path -> _Preload, until a loader takes it
+_preloads_lock = threading.Lock()
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _preload_worker(jobs):
+    while True:
+        try:
+            job = jobs.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            job.value = job.read(job.path)
+        except Exception:
+            # left for the loader to run into again, with the real traceback
+            pass
+        job.done.set()
+
+
+def preload(images=(), sounds=(), workers=4):
+    '''Starts decoding image files and reading sound files on worker threads.
+    Paths are absolute, e.g. from get.  load_image, load_sheet, load_sound and
+    decode_image take the results, waiting for any still in progress, so this
+    can be started before the display or mixer is set up.  Anything an earlier
+    call preloaded that was never taken is dropped.'''
+    jobs = queue.Queue()
+    with _preloads_lock:
+        _preloads.clear()
+        for paths, read in ((images, pygame.image.load), (sounds, _read_bytes)):
+            for path in paths:
+                path = os.path.abspath(path)
+                job = _preloads[path] = _Preload(path, read)
+                jobs.put(job)
+
+    for _ in range(min(workers, jobs.qsize())):
+        thread = threading.Thread(target=_preload_worker, args=(jobs,),
+                                  name='preload')
+        thread.daemon = True
+        thread.start()
+
+
+def _take(path):
+    '''Returns what was preloaded for path, or None.'''
+    with _preloads_lock:
+        job = _preloads.pop(os.path.abspath(path), None)
+    if job is None:
+        return None
+    job.done.wait()
+    return job.value
+
+
+def decode_image(path):
+    '''Loads an image file without converting it, preloaded if it was.'''
+    image = _take(path)
+    if image is None:
+        image = pygame.image.load(path)
+    return image
+
+
+def _convert(surface, alpha):
+    # convert needs a display mode, without one keep the surface as loaded
+    if pygame.display.get_surface() is None:
+        return surface
+    if alpha:
+        return surface.convert_alpha()
+    return surface.convert()
+
+
+def load_image(filename, alpha=True):
+    '''Loads a packaged image, converted for fast blitting.'''
+    def loader():
+        return _convert(decode_image(get(filename)), alpha)
+    return cache.get(('image', filename, alpha), loader)
+
+
+def _slice_sheet(sheet, rows, cols):
+    # the frames pyganim.getImagesFromSpriteSheet makes, left to right, top to bottom
+    width = sheet.get_width() // cols
+    height = sheet.get_height() // rows
+    frames = []
+    for y in range(0, height * rows, height):
+        for x in range(0, width * cols, width):
+            frame = pygame.Surface((width, height), 0, sheet)
+            frame.blit(sheet, (0, 0), (x, y, width, height), pygame.BLEND_RGBA_ADD)
+            frames.append(frame)
+    return frames
+
+
+def load_sheet(filename, rows, cols, alpha=True):
+    '''Loads a packaged sprite sheet sliced into a list of frames.  The list is
+    shared, so do not modify it.'''
+    def loader():
+        images = _slice_sheet(decode_image(get(filename)), rows, cols)
+        return [_convert(image, alpha) for image in images]
+    return cache.get(('sheet', filename, rows, cols, alpha), loader)
+
+
+def load_sound(filename):
+    '''Loads a packaged sound.  Needs pygame.mixer.init().'''
+    def loader():
+        data = _take(get(filename))
+        if data is None:
+            return pygame.mixer.Sound(get(filename))
+        return pygame.mixer.Sound(file=io.BytesIO(data))
+    return cache.get(('sound', filename), loader)
+
+
+def pygame_icon():
+    '''The window icon pygame uses by default, loaded without going through
+    pkg_resources the way pygame does.'''
+    icon = pygame.image.load(os.path.join(os.path.dirname(pygame.__file__),
+                                          'pygame_icon.bmp'))
+    icon.set_colorkey((0, 0, 0))
+    return icon
+
+
+def load_font(name, size, bold=False, italic=False):
+    '''Returns a system font, setting up pygame.font the first time.'''
+    def loader():
+        if not pygame.font.get_init():
+            pygame.font.init()
+        return pygame.font.SysFont(name, size, bold, italic)
+    return cache.get(('font', name, size, bold, italic), loader)
@@ -0,0 +1,118 @@
+'''Draws a zoomed map with its tiles and sprite images scaled up once, instead
+of drawing at 1:1 into a small buffer and scaling the whole view every frame.
+
+Only whole number zooms are supported.  Scaling is nearest neighbour, like the
+default pyscroll.BufferedRenderer, so both draw the same pixels.'''
+import pygame
+import pyscroll
+
+
+class ScaledImageCache(object):
+    '''Images scaled by zoom, keyed by the source surface.  Changing zoom
+    empties the cache.'''
+    def __init__(self, zoom=1, max_images=4096):
+        self._zoom = zoom
+        self.max_images = max_images
+        self._images = {}  # source surface -> scaled surface
+
+    def __len__(self):
+        return len(self._images)
+
+    @property
+    def zoom(self):
+        return self._zoom
+
+    @zoom.setter
+    def zoom(self, value):
+        if value != self._zoom:
+            self._zoom = value
+            self._images.clear()
+
+    def get(self, image):
+        try:
+            return self._images[image]
+        except KeyError:
+            pass
+
+        zoom = self._zoom
+        if zoom == 1:
+            scaled = image
+        else:
+            w, h = image.get_size()
+            scaled = pygame.transform.scale(image, (w * zoom, h * zoom))
+        # images made fresh every frame would otherwise pile up
+        if len(self._images) >= self.max_images:
+            self._images.clear()
+        self._images[image] = scaled
+        return scaled
+
+
+class ScaledMapData(pyscroll.data.TiledMapData):
+    '''TiledMapData with tiles scaled through an ScaledImageCache.'''
+    def __init__(self, tmx, cache):
+        super(ScaledMapData, self).__init__(tmx)
+        self.cache = cache
+
+    @property
+    def tile_size(self):
+        zoom = self.cache.zoom
+        return self.tmx.tilewidth * zoom, self.tmx.tileheight * zoom
+
+    def get_tile_image(self, position):
+        image = super(ScaledMapData, self).get_tile_image(position)
+        return self.cache.get(image) if image else image
+
+    def get_tile_image_by_gid(self, gid):
+        image = super(ScaledMapData, self).get_tile_image_by_gid(gid)
+        return self.cache.get(image) if image else image
+
+    def get_tile_images_by_rect(self, rect):
+        get = self.cache.get
+        for x, y, layer, image, gid in super(ScaledMapData, self).get_tile_images_by_rect(rect):
+            yield x, y, layer, get(image), gid
+
+
+class ScaledRenderer(pyscroll.BufferedRenderer):
+    '''A BufferedRenderer whose tile buffer is already at the zoom, so drawing
+    is a 1:1 blit.  center, get_center_offset and world_view are in map
+    pixels; view_rect and the rects of surfaces passed to draw are in screen
+    pixels, and the surfaces should come from image_cache.'''
+    def __init__(self, data, size, zoom=1, **kwargs):
+        self.image_cache = ScaledImageCache(zoom)
+        data = ScaledMapData(data.tmx, self.image_cache)
+        super(ScaledRenderer, self).__init__(data, size, **kwargs)
+
+    @property
+    def zoom(self):
+        return self.image_cache.zoom
+
+    @zoom.setter
+    def zoom(self, value):
+        if value != int(value) or value < 1:
+            raise ValueError('ScaledRenderer needs a whole number zoom, not {0}'.format(value))
+        value = int(value)
+        if value == self.image_cache.zoom:
+            return
+        center = self.world_view.center
+        self.image_cache.zoom = value
+        self._initialize_buffers(self._size)
+        self.reload_animations()
+        self.center(center)
+
+    @property
+    def world_view(self):
+        '''The part of the map in view, in map pixels.'''
+        zoom = self.image_cache.zoom
+        v = self.view_rect
+        return pygame.Rect(v.x // zoom, v.y // zoom, v.width // zoom, v.height // zoom)
+
+    def center(self, coords):
+        # round in map pixels, as the unscaled renderer would
+        zoom = self.image_cache.zoom
+        x, y = [round(i, 0) * zoom for i in coords]
+        super(ScaledRenderer, self).center((x, y))
+
+    def get_center_offset(self):
+        zoom = self.image_cache.zoom
+        x, y = super(ScaledRenderer, self).get_center_offset()
+        return x // zoom, y // zoom
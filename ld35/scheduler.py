@@ -0,0 +1,87 @@
+from collections import OrderedDict
+import itertools
+
+from spatial import SpatialHash
+
+
+class SleepMixin(object):
+    '''An object a Scheduler may stop updating while nothing is happening to
+    it.  Override can_sleep, and call wake when something happens to it.'''
+    scheduler = None
+
+    def can_sleep(self):
+        return True
+
+    def wake(self):
+        if self.scheduler is not None:
+            self.scheduler.wake(self)
+
+
+class Scheduler(object):
+    '''Decides which sprites of a group get updated.
+
+    Sprites that can_sleep and are further than wake_distance from the focus
+    (the player) are put to sleep, and woken when the focus comes back within
+    wake_distance or when they call wake(), e.g. because they were triggered
+    or collided with.  Sprites without can_sleep never sleep.'''
+    def __init__(self, wake_distance=320):
+        self.wake_distance = wake_distance
+        self.focus = None
+        self.awake = OrderedDict()  # sprite -> None, in the order they woke
+        self.sleeping = SpatialHash(128)
+        self._order = {}  # sprite -> order added, to wake sprites in a set order
+        self._counter = itertools.count()
+        self._can_sleep = {}  # sprite -> its can_sleep, for sprites that have one
+
+    def __len__(self):
+        '''The number of sprites being updated.'''
+        return len(self.awake)
+
+    def add(self, sprite):
+        if hasattr(sprite, 'can_sleep'):
+            sprite.scheduler = self
+            self._can_sleep[sprite] = sprite.can_sleep
+        self._order[sprite] = next(self._counter)
+        self.awake[sprite] = None
+
+    def remove(self, sprite):
+        if sprite in self.sleeping:
+            self.sleeping.remove(sprite)
+        self.awake.pop(sprite, None)
+        self._order.pop(sprite, None)
+        if self._can_sleep.pop(sprite, None) is not None:
+            sprite.scheduler = None
+
+    def wake(self, sprite):
+        if sprite in self.sleeping:
+            self.sleeping.remove(sprite)
+            self.awake[sprite] = None
+
+    def _near(self):
+        d = self.wake_distance
+        return self.focus.rect.inflate(d * 2, d * 2)
+
+    def update(self, *args, **kwargs):
+        near = None
+        if self.focus is not None:
+            near = self._near()
+            nearby = self.sleeping.query(near)
+            for sprite in sorted(nearby, key=self._order.__getitem__):
+                if near.colliderect(sprite.rect):
+                    self.wake(sprite)
+
+        for sprite in list(self.awake):
+            sprite.update(*args, **kwargs)
+
+        if near is None:
+            return
+
+        # sleep what has settled down away from the player
+        near = self._near()
+        sleepers = self._can_sleep
+        for sprite in list(self.awake):
+            can_sleep = sleepers.get(sprite)
+            if (can_sleep is not None and not near.colliderect(sprite.rect)
+                    and can_sleep()):
+                del self.awake[sprite]
+                self.sleeping.add(sprite)
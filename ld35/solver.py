@@ -0,0 +1,307 @@
+'''Checks that maps can be solved, without running the game.
+
+A map is turned into an abstract puzzle: the player steps a movestep at a time
+on the floor it is on, switches and platforms fire their targets when entered
+and platforms toggle between floors 0 and 1.  Platforms are assumed to finish
+moving before the player moves again.  A breadth first search over the player's
+cell, floor and trigger and platform states then finds the fewest steps to the
+Keystone and which triggers can never be reached.
+
+    python -m ld35.solver map.tmx [map.tmx ...] [--jobs N]
+
+Several maps are searched in a process pool.  Results are printed as JSON and
+the exit status is 1 if any map can not be solved.
+'''
+import argparse
+from collections import deque
+import json
+import multiprocessing
+import sys
+
+import pygame
+import pytmx
+
+import gameobjects
+from collision import build_collision_grids
+
+# name, d_x, d_y
+MOVES = (('L', -1, 0), ('R', 1, 0), ('U', 0, -1), ('D', 0, 1))
+
+
+class Trigger(object):
+    '''What the solver needs to know about one TriggerMixin from the map.'''
+    __slots__ = ('id', 'kind', 'rect', 'floor', 'target', 'platform', 'destination')
+
+    def __init__(self, id, kind, rect, floor):
+        self.id = id
+        self.kind = kind  # the game object class name
+        self.rect = rect
+        self.floor = floor
+        self.target = None       # index into Puzzle.platforms this fires, if any
+        self.platform = None     # index into Puzzle.platforms if this is one
+        self.destination = None  # rect a Teleport moves the player into
+
+
+def _toggle(floors, platform):
+    # RisingPlatform.on_trigger
+    floors = list(floors)
+    floors[platform] = 1 if floors[platform] == 0 else 0
+    return tuple(floors)
+
+
+class Puzzle(object):
+    '''The player, walls and triggers of a map as a state graph.
+
+    A state is (x, y, floor, tracked, platform floors, won), where tracked is
+    the index of the trigger the player is in and has entered (-1 for none),
+    since a trigger only fires again once the player has left it.'''
+    def __init__(self, tmx_data, movestep=16, player_size=(32, 32)):
+        self.movestep = movestep
+        self.player_size = player_size
+        self.bounds = pygame.Rect(0, 0, tmx_data.width * tmx_data.tilewidth,
+                                  tmx_data.height * tmx_data.tileheight)
+
+        self.triggers = []   # in load order, which decides which one the player hits
+        self.platforms = []  # trigger indices of platforms
+        start = None
+        walls = {}
+        objects = {}
+        targets = []  # (trigger, target ID)
+        for o in tmx_data.objects:
+            objects[int(o.id)] = o
+            floor = int(o.properties.get('floor', 0))
+            rect = pygame.Rect(o.x, o.y, o.width, o.height)
+            if o.type == 'Wall':
+                walls.setdefault(floor, []).append(rect)
+                continue
+            klass = getattr(gameobjects, o.type, None)
+            if klass is None or not hasattr(klass, 'from_tmx'):
+                continue
+            if o.name == 'Player':
+                start = (o.x, o.y, floor)
+            if not issubclass(klass, gameobjects.TriggerMixin):
+                continue
+
+            if issubclass(klass, gameobjects.RisingPlatform):
+                # from_tmx makes platforms 32x32 whatever the object's size
+                rect.size = (32, 32)
+            trigger = Trigger(int(o.id), o.type, rect, floor)
+            if issubclass(klass, gameobjects.RisingPlatform):
+                trigger.platform = len(self.platforms)
+                self.platforms.append(len(self.triggers))
+            target_id = o.properties.get('target_id')
+            if target_id is not None:
+                targets.append((trigger, int(o.id) if target_id == 'self' else int(target_id)))
+            if o.type == 'Teleport':
+                targets.append((trigger, int(o.properties.get('destination'))))
+            self.triggers.append(trigger)
+
+        if start is None:
+            raise ValueError('map has no Player')
+        if not any(t.kind == 'Keystone' for t in self.triggers):
+            raise ValueError('map has no Keystone')
+
+        by_id = dict((t.id, t) for t in self.triggers)
+        for trigger, target_id in targets:
+            if trigger.kind == 'Teleport':
+                o = objects.get(target_id)
+                if o is not None:
+                    trigger.destination = pygame.Rect(o.x, o.y, o.width, o.height)
+            elif target_id in by_id and by_id[target_id].platform is not None:
+                trigger.target = by_id[target_id].platform
+
+        self.collision = build_collision_grids(tmx_data, walls)
+        self._colliders = {}
+
+        # Player.update rounds its destination to the movestep
+        x, y, floor = start
+        l = lambda v: int((v + 8) // movestep) * movestep
+        floors = tuple(self.triggers[i].floor for i in self.platforms)
+        self.start, self.entered = self._arrive(l(x), l(y), floor, -1, floors)
+
+    def _collider(self, x, y):
+        '''The index of the trigger the player hits at x, y, like Game.on_collide.'''
+        key = (x, y)
+        try:
+            return self._colliders[key]
+        except KeyError:
+            pass
+        w, h = self.player_size
+        hotspot = pygame.Rect(x, y, w, h).inflate(-w / 4, -h / 4)
+        collider = -1
+        for i, trigger in enumerate(self.triggers):
+            if hotspot.colliderect(trigger.rect):
+                collider = i
+                break
+        self._colliders[key] = collider
+        return collider
+
+    def _arrive(self, x, y, floor, tracked, floors, back=None):
+        '''Works out what happens when the player gets to x, y.  back is where
+        it came from, for when it gets pushed back.  Returns the new state and
+        the index of the trigger entered, or -1.'''
+        won = False
+        collider = self._collider(x, y)
+        entered = -1
+        if collider == -1:
+            tracked = -1
+        elif collider != tracked:
+            entered = collider
+            trigger = self.triggers[collider]
+            tracked = collider
+            fire = False
+            kind = trigger.kind
+            if trigger.platform is not None:
+                p = trigger.platform
+                mismatch = floors[p] != floor
+                if kind == 'RisingPlatform':
+                    w, h = self.player_size
+                    center = (x + w / 2, y + h / 2)
+                    if mismatch:
+                        tracked = -1
+                    elif trigger.rect.inflate(-16, -16).collidepoint(center):
+                        fire = True
+                    else:
+                        tracked = -1
+                else:
+                    # FallingPlatform and RisingFallingPlatform move themselves
+                    if kind == 'RisingFallingPlatform' or floors[p] == 1:
+                        floors = _toggle(floors, p)
+                    if mismatch:
+                        tracked = -1
+
+                if mismatch and back is not None:
+                    # Player.move_back, then it comes back into whatever is there
+                    state, _ = self._arrive(back[0], back[1], floor, -1, floors)
+                    return state, entered
+            elif kind == 'Switch':
+                fire = floor == trigger.floor
+            elif kind == 'Keystone':
+                won = True
+            elif kind == 'Teleport' and trigger.destination is not None:
+                w, h = self.player_size
+                r = pygame.Rect(x, y, w, h).clamp(trigger.destination)
+                state, _ = self._arrive(r.x, r.y, floor, collider, floors)
+                return state, entered
+
+            if fire and trigger.target is not None:
+                floors = _toggle(floors, trigger.target)
+
+        # a platform carries whatever it tracks up and down with it
+        if tracked != -1 and self.triggers[tracked].platform is not None:
+            floor = floors[self.triggers[tracked].platform]
+
+        return (x, y, floor, tracked, floors, won), entered
+
+    def moves(self, state):
+        '''Yields (move name, next state, index of trigger entered or -1).'''
+        x, y, floor, tracked, floors, won = state
+        step = self.movestep
+        w, h = self.player_size
+        grid = self.collision.get(floor)
+        for name, d_x, d_y in MOVES:
+            n_x, n_y = x + d_x * step, y + d_y * step
+            rect = pygame.Rect(n_x, n_y, w, h)
+            if not self.bounds.contains(rect):
+                continue
+            if grid is not None and grid.collide(rect):
+                continue
+            next_state, entered = self._arrive(n_x, n_y, floor, tracked, floors, (x, y))
+            if next_state != state:
+                yield name, next_state, entered
+
+    def solve(self, max_states=1000000):
+        '''Searches every state reachable from the start.  Returns a dict with
+        the shortest solution (as a string of L, R, U and D), the states seen
+        and the IDs of triggers that can never be entered.'''
+        start = self.start
+        parents = {start: None}
+        queue = deque([start])
+        entered = set([self.entered])
+        goal = start if start[5] else None
+        complete = True
+        while queue:
+            state = queue.popleft()
+            if state[5]:
+                # the game is over once the Keystone is reached
+                continue
+            for name, next_state, trigger in self.moves(state):
+                entered.add(trigger)
+                if next_state in parents:
+                    continue
+                parents[next_state] = (state, name)
+                if goal is None and next_state[5]:
+                    goal = next_state
+                queue.append(next_state)
+            if len(parents) >= max_states:
+                complete = False
+                break
+
+        solution = None
+        if goal is not None:
+            path = []
+            state = goal
+            while parents[state] is not None:
+                state, name = parents[state]
+                path.append(name)
+            solution = ''.join(reversed(path))
+
+        return {
+            'solvable': goal is not None,
+            'solution_length': len(solution) if solution is not None else None,
+            'solution': solution,
+            'states': len(parents),
+            'complete': complete,
+            'unreachable_triggers': sorted(t.id for i, t in enumerate(self.triggers)
+                                           if i not in entered),
+        }
+
+
+def solve_file(filename, max_states=1000000):
+    '''Loads and solves one map.  Errors in the map are reported, not raised,
+    so one bad map does not stop a pool.'''
+    try:
+        puzzle = Puzzle(pytmx.TiledMap(filename))
+        result = puzzle.solve(max_states)
+    except Exception as e:
+        result = {'solvable': False, 'error': '{0}: {1}'.format(type(e).__name__, e)}
+    result['map'] = filename
+    return result
+
+
+def _solve_args(args):
+    return solve_file(*args)
+
+
+def solve_files(filenames, jobs=None, max_states=1000000):
+    '''Solves maps, in a process pool of jobs processes when there are
+    several.  Returns the results in the order of filenames.'''
+    work = [(filename, max_states) for filename in filenames]
+    if jobs == 1 or len(work) < 2:
+        return [_solve_args(args) for args in work]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(_solve_args, work)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks that maps can be solved.')
+    parser.add_argument('maps', nargs='+')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='processes to search with (default: one per CPU)')
+    parser.add_argument('--max-states', type=int, default=1000000,
+                        help='give up on a map after this many states')
+    args = parser.parse_args(argv)
+
+    results = solve_files(args.maps, args.jobs, args.max_states)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 0 if all(r['solvable'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import pygame
+
+
+class SpatialHash(object):
+    '''Buckets objects with a rect attribute into square cells so that lookups
+    only have to look at the objects near the query rect.
+
+    Objects are only re-bucketed when update is called and their rect has
+    actually changed since they were last bucketed.  Objects that say when
+    they move (see moved) can be re-bucketed with update_moved instead of
+    calling update on every object.'''
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}  # (column, row) -> set of objects
+        self.items = {}  # object -> (rect it was bucketed with, list of cells)
+        self._moved = set()  # objects marked by moved since update_moved
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def _cells_for(self, rect):
+        size = self.cell_size
+        return [(column, row)
+                for column in range(rect.left // size, (rect.right - 1) // size + 1)
+                for row in range(rect.top // size, (rect.bottom - 1) // size + 1)]
+
+    def add(self, item):
+        rect = pygame.Rect(item.rect)
+        keys = self._cells_for(rect)
+        for key in keys:
+            self.cells.setdefault(key, set()).add(item)
+        self.items[item] = (rect, keys)
+
+    def remove(self, item):
+        rect, keys = self.items.pop(item)
+        self._moved.discard(item)
+        for key in keys:
+            bucket = self.cells[key]
+            bucket.discard(item)
+            if not bucket:
+                del self.cells[key]
+
+    def update(self, item):
+        '''Re-buckets item if its rect moved.  Returns True if it did.'''
+        if self.items[item][0] == item.rect:
+            return False
+        self.remove(item)
+        self.add(item)
+        return True
+
+    def moved(self, item):
+        '''Marks item to be re-bucketed by the next update_moved.  Call after
+        changing its rect.'''
+        if item in self.items:
+            self._moved.add(item)
+
+    def update_moved(self):
+        '''Re-buckets the items marked by moved.  Returns how many moved.'''
+        moved = self._moved
+        if not moved:
+            return 0
+        self._moved = set()
+        return sum(1 for item in moved if self.update(item))
+
+    def query(self, rect):
+        '''Returns the set of objects in the cells rect touches.  Callers still
+        need to do their own narrow phase test.'''
+        cells = self.cells
+        found = set()
+        for key in self._cells_for(rect):
+            bucket = cells.get(key)
+            if bucket:
+                found.update(bucket)
+        return found
@@ -7,16 +7,72 @@ class Tileset(object):
 
 
 class Tilemap(object):
-    def __init__(self, image, width, height):
+    """A grid of tiles, each an index into images (None for no tile).  Every
+    tile starts as images[0], the image given."""
+    # tiles per side of each pre-rendered chunk
+    chunk_size = 16
+
+    def __init__(self, image, width, height, chunked=True):
         self._sprite = pygame.sprite.Sprite()
         self._sprite.image = image
         self._sprite.rect = image.get_rect()
+        self.images = [image]
 
         self.width = width
         self.height = height
-        self.tiles = [[0 for x in range(width)] for y in range(height)]
+        # width and height are in pixels, the grid is in tiles
+        self.tiles = [[0] * self.columns for _ in range(self.rows)]
+
+        self.chunked = chunked
+        self._chunks = {}  # (chunk column, chunk row) -> baked surface
+
+    @property
+    def columns(self):
+        return self.width // self._sprite.rect.width
+
+    @property
+    def rows(self):
+        return self.height // self._sprite.rect.height
+
+    def set_tile(self, column, row, value):
+        """Changes a tile, re-rendering only the chunk it is in."""
+        self.tiles[row][column] = value
+        self._chunks.pop((column // self.chunk_size, row // self.chunk_size), None)
+
+    def invalidate(self):
+        """Throws away every pre-rendered chunk, e.g. after changing images."""
+        self._chunks.clear()
+
+    def tile_image(self, column, row):
+        value = self.tiles[row][column]
+        return None if value is None else self.images[value]
+
+    def _bake_chunk(self, chunk_column, chunk_row):
+        tw, th = self._sprite.rect.size
+        size = self.chunk_size
+        first_column = chunk_column * size
+        first_row = chunk_row * size
+        columns = min(size, self.columns - first_column)
+        rows = min(size, self.rows - first_row)
+
+        chunk = pygame.Surface((columns * tw, rows * th), pygame.SRCALPHA, 32)
+        chunk.fill((0, 0, 0, 0))
+        for c in range(columns):
+            for r in range(rows):
+                image = self.tile_image(first_column + c, first_row + r)
+                if image is not None:
+                    chunk.blit(image, (c * tw, r * th))
+
+        if pygame.display.get_surface() is not None:
+            chunk = chunk.convert_alpha()
+        self._chunks[(chunk_column, chunk_row)] = chunk
+        return chunk
 
     def draw(self, surface, camera):
+        if self.chunked:
+            self.draw_chunks(surface, camera)
+            return
+
         columns = self.width / self._sprite.rect.width
         rows = self.height / self._sprite.rect.height
 
@@ -29,4 +85,29 @@ class Tilemap(object):
                     draw_rect = self._sprite.rect
                     draw_rect.x -= camera.x
                     draw_rect.y -= camera.y
-                    surface.blit(self._sprite.image, self._sprite.rect)
+                    image = self.tile_image(c, r)
+                    if image is not None:
+                        surface.blit(image, self._sprite.rect)
+
+    def draw_chunks(self, surface, camera):
+        """Blits the pre-rendered chunks that overlap the camera."""
+        tw, th = self._sprite.rect.size
+        chunk_w = self.chunk_size * tw
+        chunk_h = self.chunk_size * th
+
+        # visible tiles, clamped to the map
+        first_column = max(0, camera.left // tw)
+        first_row = max(0, camera.top // th)
+        last_column = min(self.columns, (camera.right - 1) // tw + 1) - 1
+        last_row = min(self.rows, (camera.bottom - 1) // th + 1) - 1
+        if last_column < first_column or last_row < first_row:
+            return
+
+        chunks = self._chunks
+        blit = surface.blit
+        for cx in range(first_column // self.chunk_size, last_column // self.chunk_size + 1):
+            for cy in range(first_row // self.chunk_size, last_row // self.chunk_size + 1):
+                chunk = chunks.get((cx, cy))
+                if chunk is None:
+                    chunk = self._bake_chunk(cx, cy)
+                blit(chunk, (cx * chunk_w - camera.x, cy * chunk_h - camera.y))
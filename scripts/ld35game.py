@@ -1,6 +1,30 @@
 #!/usr/bin/env python
+from timeit import default_timer
+started = default_timer()
+
+import argparse
+
 import ld35
+from ld35.profiler import StartupProfiler
 
 if __name__ == "__main__":
-    game = ld35.game.Game()
+    startup = StartupProfiler(started)
+    startup.lap('import')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--record', metavar='FILE',
+                        help='record keys to FILE, to be replayed with python -m ld35.replay')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='print how long each stage of starting up took')
+    parser.add_argument('--profile-csv', metavar='FILE',
+                        help='write the per-frame profile to FILE on exit')
+    args = parser.parse_args()
+
+    game = ld35.game.Game(startup=startup)
+    if args.startup_profile:
+        print(startup.report())
+    if args.record:
+        game.record(args.record)
+    if args.profile_csv:
+        game.profile_csv = args.profile_csv
     game.run()
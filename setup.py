@@ -20,11 +20,14 @@ setup(
     setup_requires=['setuptools-markdown'],
     install_requires = [
         'pygame>=1.9.1',
-        'Pyganim>=0.9.2',
         'pyscroll>=2.16.6',
         'PyTMX>=3.20.14',
         'six>=1.10.0',
     ],
+    extras_require = {
+        # for Game(entity_store=True)
+        'numpy': ['numpy'],
+    },
     scripts = ['scripts/ld35game.py'],
 
     # this is to compensate for pytmx.